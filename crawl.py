@@ -0,0 +1,40 @@
+"""Continuously sync players from the queue, several at a time, until interrupted.
+
+    python crawl.py --concurrency 8 --min-interval 3600
+
+Ctrl+C (or SIGTERM) stops the crawl once the jobs in progress finish. Crawlers on several hosts
+can share one database, each player is leased to one crawler at a time.
+"""
+
+
+import argparse
+
+from haloinfinite import auth, api, crawler, db, ratelimit
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=4, help='players synced at the same time')
+    parser.add_argument('--in-flight', type=int, default=32, help='max page requests in flight per player')
+    parser.add_argument('--min-interval', type=float, default=3600, help='shortest time between probes of a player in seconds')
+    parser.add_argument('--max-interval', type=float, default=7 * 86400, help='longest time between probes of a player in seconds')
+    parser.add_argument('--idle-wait', type=float, default=60, help='seconds between queue checks when no player is due')
+    parser.add_argument('--lease-seconds', type=float, default=300, help='how long a player stays leased to this crawler without renewal')
+    parser.add_argument('--test-db', action='store_true', help='crawl the test database')
+    args = parser.parse_args()
+
+    auth_mgr = auth.AuthManager()
+
+    # share the host-wide request budget with every other crawler process
+    hapi = api.ApiService(auth_mgr, rate_limiter=ratelimit.RateLimiter())
+    hapi.verify_or_refresh_tokens()
+
+    pgdb = db.Database(db.TEST_DB if args.test_db else db.PROD_DB)
+
+    c = crawler.Crawler(hapi, pgdb, args.concurrency, args.in_flight, args.min_interval, args.max_interval, args.idle_wait,
+        lease_seconds=args.lease_seconds)
+    c.install_signal_handlers()
+
+    with auth.TokenRefresher(auth_mgr):
+        c.run()
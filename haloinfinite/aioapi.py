@@ -0,0 +1,280 @@
+import asyncio, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Union
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from haloinfinite import api, cache, identity, ratelimit, singleflight, throttle, transport
+
+
+class AsyncApiService(api.ApiService):
+    '''Asyncio counterpart of ApiService.
+
+    Every endpoint method of ApiService is inherited as-is and returns an awaitable here,
+    e.g. `await async_api.get_player_matches(xuid, start)`, because the request helpers
+    they delegate to are coroutines. Use as an async context manager, or await close(),
+    so the sessions are released on the event loop that opened them.'''
+
+    def __init__(self, auth_mgr, pool_size:int=api.ApiService.DEFAULT_POOL_SIZE, rate_limiter:ratelimit.RateLimiter=None,
+        response_cache:cache.ResponseCache=None, decoder:str='auto', transport:Union[transport.RecordingTransport, transport.ReplayTransport]=None,
+        base_urls:dict=None, timeouts:dict=None, hedge:bool=False, identities:identity.IdentityPool=None):
+
+        super().__init__(auth_mgr, pool_size, rate_limiter, response_cache, decoder, transport, base_urls, timeouts, hedge, identities)
+        self._aio_sessions = {}
+        self.controller = throttle.AsyncConcurrencyController()
+        self.single_flight = singleflight.AsyncSingleFlight()
+        # threads waiting on response cache key locks, apart from the default executor so waiters
+        # can't take every thread while the holders need one to store their response
+        self._lock_executor = None
+
+
+    @classmethod
+    def from_service(cls, halo_api:api.ApiService, pool_size:int=None):
+        '''Create an async service configured like an existing ApiService.'''
+
+        return cls(halo_api.auth_mgr, pool_size or halo_api.pool_size, halo_api.rate_limiter, halo_api.response_cache,
+            halo_api.decoder, halo_api.transport, halo_api.base_urls, halo_api.timeouts, halo_api.hedge, halo_api.identities)
+
+
+    async def __aenter__(self):
+
+        return self
+
+
+    async def __aexit__(self, *exc_info):
+
+        await self.close()
+
+
+    def get_session(self, url:str) -> aiohttp.ClientSession:
+        '''Get the keep-alive session for the authority of the url, creating it on first use.'''
+
+        authority = urlsplit(url).hostname
+        session = self._aio_sessions.get(authority)
+        if session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            session = aiohttp.ClientSession(connector=connector)
+            self._aio_sessions[authority] = session
+        return session
+
+
+    async def close(self):
+
+        for session in self._aio_sessions.values():
+            await session.close()
+        self._aio_sessions = {}
+        if self._lock_executor is not None:
+            self._lock_executor.shutdown(wait=False)
+            self._lock_executor = None
+
+
+    @staticmethod
+    def _to_query(params:dict) -> list[tuple]:
+
+        # aiohttp doesn't expand list values into repeated keys like requests does
+        query = []
+        for key, value in (params or {}).items():
+            values = value if isinstance(value, list) else [value]
+            query.extend((key, str(v)) for v in values)
+        return query
+
+
+    def _send(self, method:str, url:str, **kwargs):
+        '''Open a request, to be used as an async context manager yielding the response.'''
+
+        if self.transport is not None:
+            return self.transport.send_async(self.get_session(url), method, url, **kwargs)
+        return self.get_session(url).request(method, url, **kwargs)
+
+
+    async def _exchange(self, method:str, url:str, **kwargs):
+        '''Send the request and read the body, returning (response, body).'''
+
+        async with self._send(method, url, **kwargs) as resp:
+            return resp, await resp.read()
+
+
+    async def _exchange_in_slot(self, family:str, block_family:bool, method:str, url:str, **kwargs):
+        '''Exchange in the controller slot taken for it, and release the slot with its own latency and status.'''
+
+        started_at = time.monotonic()
+        try:
+            resp, body = await self._exchange(method, url, **kwargs)
+        except asyncio.CancelledError:
+            await self.controller.abandon(family, time.monotonic() - started_at)
+            raise
+        except BaseException:
+            await self.controller.release(family, time.monotonic() - started_at, None)
+            raise
+        retry_after = throttle.parse_retry_after(resp.headers.get('Retry-After')) if block_family else None
+        await self.controller.release(family, time.monotonic() - started_at, resp.status, retry_after)
+        return resp, body
+
+
+    async def _exchange_hedged(self, family:str, rate_limiter:ratelimit.RateLimiter, block_family:bool, method:str, url:str, **kwargs):
+        '''Exchange, and if hedging is on and the request runs past the family's p95 latency, send a duplicate.
+        Each request holds its own controller slot, the duplicate is only sent if a slot is free.
+        The first successful exchange wins and the other is cancelled.'''
+
+        delay = self.controller.hedge_delay(family) if self.hedge and method == 'GET' else None
+        await self.controller.acquire(family)
+        if delay is None:
+            return await self._exchange_in_slot(family, block_family, method, url, **kwargs)
+
+        first = asyncio.ensure_future(self._exchange_in_slot(family, block_family, method, url, **kwargs))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+
+        # hedging shouldn't add load to a family that's already at its limit, check before spending a token
+        if not self.controller.try_acquire(family):
+            return await first
+        if rate_limiter is not None:
+            try:
+                await rate_limiter.acquire_async(family)
+            except BaseException:
+                await self.controller.release_unused(family)
+                raise
+        pending = {first, asyncio.ensure_future(self._exchange_in_slot(family, block_family, method, url, **kwargs))}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            # both failed
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+    async def _request(self, method:str, url:str, **kwargs) -> bytes:
+        '''Send a request through the concurrency controller for the url's endpoint family and return the body,
+        retrying throttled (429), failed (5xx), timed out and dropped requests.'''
+
+        family = self.get_family(url)
+        connect_timeout, read_timeout = self.timeouts.get(family, api.FALLBACK_TIMEOUT)
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout))
+
+        for attempt in range(self.MAX_ATTEMPTS):
+            last_attempt = attempt == self.MAX_ATTEMPTS - 1
+            status = None
+            ident = await self.identities.checkout_async() if self.identities is not None else None
+            rate_limiter = self.rate_limiter if ident is None else ident.rate_limiter
+            attempt_kwargs = kwargs if ident is None else {**kwargs, 'headers': self._authorize(kwargs.get('headers') or {}, ident)}
+            retry_after = None
+            try:
+                if rate_limiter is not None:
+                    await rate_limiter.acquire_async(family)
+                try:
+                    resp, body = await self._exchange_hedged(family, rate_limiter, ident is None, method, url, **attempt_kwargs)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if last_attempt:
+                        raise
+                else:
+                    status = resp.status
+                    retry_after = throttle.parse_retry_after(resp.headers.get('Retry-After'))
+                    if not self._is_retryable(resp.status) or last_attempt:
+                        resp.raise_for_status()
+                        return body
+            finally:
+                if ident is not None:
+                    self.identities.release(ident, status, retry_after)
+
+            if ident is not None and status in (401, 429):
+                # the next attempt goes out as another identity
+                continue
+            # Retry-After blocks the whole family in the controller, otherwise back off this request only
+            if retry_after is None or ident is not None:
+                await asyncio.sleep(self.RETRY_BACKOFF * 2 ** attempt)
+
+
+    async def _get_json(self, url:str, user_agent:str, params:dict=None, immutable:bool=False):
+
+        key = cache.ResponseCache.make_key(url, params)
+        return await self.single_flight.do(key, self._fetch_json, key, url, user_agent, params, immutable)
+
+
+    @asynccontextmanager
+    async def _hold_cache_lock(self, key:str):
+        '''Hold the response cache's host-wide lock for the key, waiting for it off the loop.'''
+
+        if self._lock_executor is None:
+            self._lock_executor = ThreadPoolExecutor(thread_name_prefix='cache-lock')
+        lock = self.response_cache.lock(key)
+        acquired = asyncio.get_running_loop().run_in_executor(self._lock_executor, lock.__enter__)
+        try:
+            await asyncio.shield(acquired)
+        except asyncio.CancelledError:
+            # the thread still takes the lock, give it back once it does
+            acquired.add_done_callback(lambda f: f.exception() is None and lock.__exit__(None, None, None))
+            raise
+        try:
+            yield
+        finally:
+            # releasing closes the lock file, which doesn't block
+            lock.__exit__(None, None, None)
+
+
+    async def _fetch_json(self, key:str, url:str, user_agent:str, params:dict, immutable:bool):
+
+        headers = self._get_headers(user_agent)
+        if not immutable or self.response_cache is None:
+            return self._decode(await self._request('GET', url, params=self._to_query(params), headers=headers))
+
+        # like ApiService, callers in other processes after the same response wait here, then read
+        # what the first one cached. The cache is sqlite, which can wait on writers for seconds.
+        loop = asyncio.get_running_loop()
+        async with self._hold_cache_lock(key):
+            body = await loop.run_in_executor(None, self.response_cache.get, key)
+            if body is None:
+                body = await self._request('GET', url, params=self._to_query(params), headers=headers)
+                await loop.run_in_executor(None, self.response_cache.put, key, url, body)
+        return self._decode(body)
+
+
+    async def _post_json(self, url:str, headers:dict, js:dict):
+
+        return self._decode(await self._request('POST', url, headers=headers, json=js))
+
+
+class ServiceLoop:
+    '''An event loop running on a thread of its own, with one AsyncApiService on it.
+
+    Lets jobs started from several threads share the service's connections, concurrency controller
+    and single flight, rather than each opening its own on an event loop of its own. Use as a
+    context manager, the service is closed on the loop before the loop stops.'''
+
+    def __init__(self, halo_api:api.ApiService, pool_size:int=None):
+
+        self.api = AsyncApiService.from_service(halo_api, pool_size)
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='service-loop', daemon=True)
+
+
+    def __enter__(self):
+
+        self._thread.start()
+        return self
+
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+
+    def run(self, coro):
+        '''Run a coroutine on the loop and wait for its result. Call from any thread but the loop's own.'''
+
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+    def close(self):
+
+        self.run(self.api.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
@@ -1,51 +1,307 @@
+import os, threading, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Union
+from urllib.parse import urlsplit
+
 import requests
+from requests.adapters import HTTPAdapter
 
-from haloinfinite import util
+from haloinfinite import cache, decode, identity, ratelimit, singleflight, throttle, transport, util
 
 # haven't tested if these are actually necessary or not
 HALO_WAYPOINT_USER_AGENT = "HaloWaypoint/2021112313511900 CFNetwork/1327.0.4 Darwin/21.2.0"
 HALO_PC_USER_AGENT = "SHIVA-2043073184/6.10021.18539.0 (release; PC)"
 
+# base url per endpoint family, rate limits and concurrency are also tracked per family
+BASE_URLS = {
+    'halostats': 'https://halostats.svc.halowaypoint.com:443',
+    'skill': 'https://skill.svc.halowaypoint.com:443',
+    'discovery': 'https://discovery-infiniteugc.svc.halowaypoint.com',
+    'profile': 'https://profile.xboxlive.com'
+}
+
+# (connect, read) timeouts in seconds per endpoint family
+DEFAULT_TIMEOUTS = {
+    'halostats': (3.05, 20),
+    'skill': (3.05, 20),
+    'discovery': (3.05, 20),
+    'profile': (3.05, 20)
+}
+FALLBACK_TIMEOUT = (3.05, 30)
+
+# keep-alive sessions keyed by (process id, authority, pool size)
+# keying on the pid means forked pool workers never reuse the parent's sockets and each
+# worker builds its own session once, no matter how many times an ApiService is unpickled into it
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# threads that send hedged requests, per process like the sessions
+_hedge_executors = {}
+
+
+def _get_hedge_executor() -> ThreadPoolExecutor:
+
+    pid = os.getpid()
+    with _sessions_lock:
+        if pid not in _hedge_executors:
+            _hedge_executors[pid] = ThreadPoolExecutor(thread_name_prefix='hedge')
+        return _hedge_executors[pid]
+
 
 class ApiService:
     '''Wrapper for select endpoints servicing Halo Infinite.'''
 
     PLAYER_MATCHES_BATCH_SIZE = 25
+    DEFAULT_POOL_SIZE = 10
+    MAX_ATTEMPTS = 5
+    RETRY_BACKOFF = 0.5 # seconds, doubled per attempt when the service doesn't send Retry-After
+
+    def __init__(self, auth_mgr, pool_size:int=DEFAULT_POOL_SIZE, rate_limiter:ratelimit.RateLimiter=None,
+        response_cache:cache.ResponseCache=None, decoder:str='auto', transport:Union[transport.RecordingTransport, transport.ReplayTransport]=None,
+        base_urls:dict=None, timeouts:dict=None, hedge:bool=False, identities:identity.IdentityPool=None):
+
+        # with an identity pool, auth_mgr may be None and only builds the headers that each attempt's identity replaces
+        self.auth_mgr = auth_mgr if auth_mgr is not None else identities.identities[0].auth_mgr
+        # override the base url of any endpoint family, e.g. to point at a mock server
+        self.base_urls = {**BASE_URLS, **(base_urls or {})}
+        # max connections kept alive per authority, e.g. halostats.svc.halowaypoint.com
+        self.pool_size = pool_size
+        # the limiter's state is on disk, so every instance and pool worker on the host shares its budget
+        # None (the default) disables rate limiting, e.g. for replays and mock servers
+        self.rate_limiter = rate_limiter
+        # opt-in persistent cache for endpoints whose responses never change
+        self.response_cache = response_cache
+        # JSON backend for response bodies, see decode.BACKENDS
+        # "lazy" only materializes the fields that are read, which suits pages that are flattened right away
+        self.decoder = decode.resolve_backend(decoder)
+        # optionally record traffic to, or replay it from, an archive
+        self.transport = transport
+        # (connect, read) timeouts per endpoint family, merged over DEFAULT_TIMEOUTS
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        # send a duplicate GET when one runs past the family's p95 latency, first response wins
+        self.hedge = hedge
+        # spread requests over several accounts, each with its own token and rate budget
+        # rate_limiter is unused when set, identities are limited by their own limiters
+        self.identities = identities
 
-    def __init__(self, auth_mgr):
 
-        self.auth_mgr = auth_mgr
+    def verify_or_refresh_tokens(self):
 
+        if self.identities is not None:
+            self.identities.verify_or_refresh_tokens()
+        else:
+            self.auth_mgr.get_spartan_token()
 
-    def verify_or_refresh_tokens(self):
 
-        self.auth_mgr.get_spartan_token()
+    def get_family(self, url:str) -> str:
+        '''Get the endpoint family of a url, falling back to its host name.'''
 
-    
-    def _get_json(self, url:str, user_agent:str, params:dict=None):
+        for family, base_url in self.base_urls.items():
+            if url.startswith(base_url):
+                return family
+        return urlsplit(url).hostname
 
-        headers = {
-            'x-343-authorization-spartan': self.auth_mgr.spartan_token,
+
+    def get_session(self, url:str) -> requests.Session:
+        '''Get the keep-alive session for the authority of the url, creating it on first use in this process.'''
+
+        key = (os.getpid(), urlsplit(url).hostname, self.pool_size)
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _sessions[key] = session
+        return session
+
+
+    def close(self):
+        '''Close the sessions opened by this process.'''
+
+        pid = os.getpid()
+        with _sessions_lock:
+            for key in [k for k in _sessions if k[0] == pid]:
+                _sessions.pop(key).close()
+
+
+    def _get_headers(self, user_agent:str) -> dict:
+
+        return {
+            'x-343-authorization-spartan': self.auth_mgr.get_current_spartan_token(),
             'User-Agent': user_agent,
             'Accept': 'application/json'
         }
-        resp = requests.get(url, params, headers=headers)
+
+
+    def _authorize(self, headers:dict, ident:identity.Identity) -> dict:
+        '''Get the headers with the auth tokens of the identity in place of the ones they were built with.'''
+
+        headers = dict(headers)
+        if 'x-343-authorization-spartan' in headers:
+            headers['x-343-authorization-spartan'] = ident.auth_mgr.get_current_spartan_token()
+        if 'Authorization' in headers:
+            headers['Authorization'] = ident.auth_mgr.get_xbox_live_v3_token()
+        return headers
+
+
+    def _is_retryable(self, status:int) -> bool:
+
+        # with other identities to fall back on, an unauthorized identity is benched and the request retried
+        return status in throttle.RETRYABLE_STATUSES or (status == 401 and self.identities is not None)
+
+
+    def _request(self, method:str, url:str, **kwargs) -> requests.Response:
+        '''Send a request through the concurrency controller for the url's endpoint family,
+        retrying throttled (429), failed (5xx), timed out and dropped requests.
+        With an identity pool, each attempt is sent as the identity the pool schedules.'''
+
+        family = self.get_family(url)
+        controller = throttle.get_controller()
+        kwargs.setdefault('timeout', self.timeouts.get(family, FALLBACK_TIMEOUT))
+
+        for attempt in range(self.MAX_ATTEMPTS):
+            last_attempt = attempt == self.MAX_ATTEMPTS - 1
+            resp = None
+            ident = self.identities.checkout() if self.identities is not None else None
+            rate_limiter = self.rate_limiter if ident is None else ident.rate_limiter
+            attempt_kwargs = kwargs if ident is None else {**kwargs, 'headers': self._authorize(kwargs.get('headers') or {}, ident)}
+            retry_after = None
+            try:
+                if rate_limiter is not None:
+                    rate_limiter.acquire(family)
+                try:
+                    # a throttled identity is benched by the pool rather than blocking the family for all of them
+                    resp = self._send_hedged(controller, family, rate_limiter, ident is None, method, url, **attempt_kwargs)
+                except (requests.ConnectionError, requests.Timeout):
+                    if last_attempt:
+                        raise
+                else:
+                    retry_after = throttle.parse_retry_after(resp.headers.get('Retry-After'))
+            finally:
+                if ident is not None:
+                    self.identities.release(ident, resp.status_code if resp is not None else None, retry_after)
+
+            if resp is not None and (not self._is_retryable(resp.status_code) or last_attempt):
+                break
+            if ident is not None and resp is not None and resp.status_code in (401, 429):
+                # the next attempt goes out as another identity
+                continue
+            # Retry-After blocks the whole family in the controller, otherwise back off this request only
+            if retry_after is None or ident is not None:
+                time.sleep(self.RETRY_BACKOFF * 2 ** attempt)
+
         resp.raise_for_status()
-        return resp.json()
+        return resp
+
+
+    def _send(self, method:str, url:str, **kwargs) -> requests.Response:
+
+        if self.transport is not None:
+            return self.transport.send(self.get_session(url), method, url, **kwargs)
+        return self.get_session(url).request(method, url, **kwargs)
+
+
+    def _send_in_slot(self, controller:throttle.ConcurrencyController, family:str, block_family:bool,
+        method:str, url:str, **kwargs) -> requests.Response:
+        '''Send the request in the controller slot taken for it, and release the slot with its own latency and status.'''
+
+        started_at = time.monotonic()
+        status = retry_after = None
+        try:
+            resp = self._send(method, url, **kwargs)
+            status = resp.status_code
+            if block_family:
+                retry_after = throttle.parse_retry_after(resp.headers.get('Retry-After'))
+            return resp
+        finally:
+            controller.release(family, time.monotonic() - started_at, status, retry_after)
+
+
+    def _send_hedged(self, controller:throttle.ConcurrencyController, family:str, rate_limiter:ratelimit.RateLimiter,
+        block_family:bool, method:str, url:str, **kwargs) -> requests.Response:
+        '''Send the request, and if hedging is on and it runs past the family's p95 latency, a duplicate.
+        Each request holds its own controller slot and records its own outcome, the duplicate is only
+        sent if a slot is free. The first successful response wins, the slower request is left to finish
+        in the background. With `block_family`, a Retry-After response blocks the family in the controller.'''
+
+        delay = controller.hedge_delay(family) if self.hedge and method == 'GET' else None
+        controller.acquire(family)
+        if delay is None:
+            return self._send_in_slot(controller, family, block_family, method, url, **kwargs)
+
+        executor = _get_hedge_executor()
+        first = executor.submit(self._send_in_slot, controller, family, block_family, method, url, **kwargs)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        # hedging shouldn't add load to a family that's already at its limit, check before spending a token
+        if not controller.try_acquire(family):
+            return first.result()
+        if rate_limiter is not None:
+            try:
+                rate_limiter.acquire(family)
+            except BaseException:
+                controller.release_unused(family)
+                raise
+        pending = {first, executor.submit(self._send_in_slot, controller, family, block_family, method, url, **kwargs)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+        # both failed
+        return first.result()
+
+
+    def _get_json(self, url:str, user_agent:str, params:dict=None, immutable:bool=False):
+        '''Get the decoded response. Identical requests in flight at the same time are sent once and every
+        caller gets the same decoded object, so treat it as read-only. Responses from `immutable` endpoints
+        are served from and stored in the response cache, if one is set.'''
+
+        key = cache.ResponseCache.make_key(url, params)
+        return singleflight.get_single_flight().do(key, self._fetch_json, key, url, user_agent, params, immutable)
+
+
+    def _fetch_json(self, key:str, url:str, user_agent:str, params:dict, immutable:bool):
+
+        headers = self._get_headers(user_agent)
+        if not immutable or self.response_cache is None:
+            return self._decode(self._request('GET', url, params=params, headers=headers).content)
+
+        # pool workers after the same response wait here, then read what the first one cached
+        with self.response_cache.lock(key):
+            body = self.response_cache.get(key)
+            if body is None:
+                body = self._request('GET', url, params=params, headers=headers).content
+                self.response_cache.put(key, url, body)
+        return self._decode(body)
+
+
+    def _post_json(self, url:str, headers:dict, js:dict):
+
+        return self._decode(self._request('POST', url, headers=headers, json=js).content)
+
+
+    def _decode(self, body:bytes):
+
+        return decode.loads(body, self.decoder)
 
 
     def get_match_stats(self, match_guid:str):
 
         # match_guid = '21416434-4717-4966-9902-af7097469f74'
         # match_guid = '8d641322-8553-44f0-b991-89d028377c62'
-        url = f'https://halostats.svc.halowaypoint.com:443/hi/matches/{match_guid}/stats'
-        return self._get_json(url, HALO_PC_USER_AGENT)
+        url = f'{self.base_urls["halostats"]}/hi/matches/{match_guid}/stats'
+        return self._get_json(url, HALO_PC_USER_AGENT, immutable=True)
 
 
     def get_player_matches(self, player_xuid:str, start:int=0, count:int=25):
 
         xuid = util.wrap_xuid(player_xuid)
-        url = f'https://halostats.svc.halowaypoint.com:443/hi/players/{xuid}/matches'
+        url = f'{self.base_urls["halostats"]}/hi/players/{xuid}/matches'
         params = {
             'start': start, # offset starting at 0
             'count': count # max 25
@@ -56,13 +312,13 @@ class ApiService:
     def get_player_match_count(self, player_xuid:str):
 
         xuid = util.wrap_xuid(player_xuid)
-        url = f'https://halostats.svc.halowaypoint.com:443/hi/players/{xuid}/matches/count'
+        url = f'{self.base_urls["halostats"]}/hi/players/{xuid}/matches/count'
         return self._get_json(url, HALO_WAYPOINT_USER_AGENT)
 
 
     def get_player_match_skill(self, match_guid:str, player_xuids:list[str]):
 
-        url = f'https://skill.svc.halowaypoint.com:443/hi/matches/{match_guid}/skill'
+        url = f'{self.base_urls["skill"]}/hi/matches/{match_guid}/skill'
         params = {
             'players': [util.wrap_xuid(x) for x in player_xuids]
         }
@@ -72,35 +328,35 @@ class ApiService:
     def get_player_privacy(self, player_xuid:str):
 
         xuid = util.wrap_xuid(player_xuid)
-        url = f'https://halostats.svc.halowaypoint.com:443/hi/players/{xuid}/matches-privacy'
+        url = f'{self.base_urls["halostats"]}/hi/players/{xuid}/matches-privacy'
         return self._get_json(url, HALO_WAYPOINT_USER_AGENT)
 
 
     def get_map(self, asset_id:str, version_id:str):
 
-        url = f'https://discovery-infiniteugc.svc.halowaypoint.com/hi/maps/{asset_id}/versions/{version_id}'
-        return self._get_json(url, HALO_WAYPOINT_USER_AGENT)
+        url = f'{self.base_urls["discovery"]}/hi/maps/{asset_id}/versions/{version_id}'
+        return self._get_json(url, HALO_WAYPOINT_USER_AGENT, immutable=True)
 
 
     def get_playlist(self, asset_id:str, version_id:str):
 
         # only works with version-dependent url?
-        url = f'https://discovery-infiniteugc.svc.halowaypoint.com/hi/playlists/{asset_id}/versions/{version_id}'
-        return self._get_json(url, HALO_WAYPOINT_USER_AGENT)
+        url = f'{self.base_urls["discovery"]}/hi/playlists/{asset_id}/versions/{version_id}'
+        return self._get_json(url, HALO_WAYPOINT_USER_AGENT, immutable=True)
 
 
     def get_gamevariant(self, asset_id:str, version_id:str):
 
-        url = f'https://discovery-infiniteugc.svc.halowaypoint.com/hi/ugcGameVariants/{asset_id}/versions/{version_id}'
-        return self._get_json(url, HALO_WAYPOINT_USER_AGENT)
+        url = f'{self.base_urls["discovery"]}/hi/ugcGameVariants/{asset_id}/versions/{version_id}'
+        return self._get_json(url, HALO_WAYPOINT_USER_AGENT, immutable=True)
 
 
     def get_map_mode_pair(self, asset_id:str, version_id:str):
 
         # only works with version-dependent url?
         # this one has both map and playlist
-        url = f'https://discovery-infiniteugc.svc.halowaypoint.com/hi/mapModePairs/{asset_id}/versions/{version_id}'
-        return self._get_json(url, HALO_WAYPOINT_USER_AGENT)
+        url = f'{self.base_urls["discovery"]}/hi/mapModePairs/{asset_id}/versions/{version_id}'
+        return self._get_json(url, HALO_WAYPOINT_USER_AGENT, immutable=True)
 
 
     def get_profiles(self, player_xuids:list[str]):
@@ -109,7 +365,7 @@ class ApiService:
         '''
 
         # not technically part of halo endpoints but logically makes sense here
-        url = 'https://profile.xboxlive.com/users/batch/profile/settings'
+        url = f'{self.base_urls["profile"]}/users/batch/profile/settings'
         headers = {
             'x-xbl-contract-version': '2',
             'Content-Type': 'application/json',
@@ -119,7 +375,5 @@ class ApiService:
             'settings': ['Gamertag'],
             'userIds': [util.unwrap_xuid(x) for x in player_xuids]
         }
-        resp = requests.post(url, headers=headers, json=js)
-        resp.raise_for_status()
-        return resp.json()
+        return self._post_json(url, headers, js)
 
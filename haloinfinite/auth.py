@@ -1,11 +1,20 @@
 # see https://den.dev/blog/halo-api-authentication
 
-import requests, json, pytz
+import requests, json, os, pytz, threading
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.parser import isoparse
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
 
 from haloinfinite import util, api
 
+TOKEN_FILE = 'token.json'
+REFRESH_MARGIN = 600 # seconds, refresh when the spartan token has less than this remaining
+CHAIN_MARGIN = 60 # seconds, redo an intermediate token of the chain when it has less than this remaining
+
+
+class AuthError(Exception):
+    '''A step of the token chain failed, or the credentials aren't configured.'''
+
 
 class AuthManager:
     '''Manages acquisition and refresh of spartan tokens for authentication when calling the API.
@@ -15,7 +24,7 @@ class AuthManager:
     APPROVAL_PROMPT = 'auto'
 
 
-    def __init__(self, config_file:str='config.yaml'):
+    def __init__(self, config_file:str='config.yaml', token_file:str=TOKEN_FILE):
 
         try:
             cfg = util.load_config(config_file)['azure_aad']
@@ -23,8 +32,7 @@ class AuthManager:
             self.client_secret = cfg['client_secret']
             self.redirect_uri = cfg['redirect_uri']
         except KeyError:
-            print('Make sure your config file has "azure_aad" as a top level key and "client_id", "client_secret", and "redirect_url" under it.')
-            exit(1)
+            raise AuthError('Make sure your config file has "azure_aad" as a top level key and "client_id", "client_secret", and "redirect_url" under it.')
 
         self.auth_code = None
         self.oauth_token = None
@@ -36,35 +44,56 @@ class AuthManager:
         self.spartan_token = None
         self.expires_at = None
 
+        # expiry of each level of the chain, None when unknown so the level is redone
+        self.oauth_expires_at = None
+        self.user_expires_at = None
+        self.halo_xsts_expires_at = None
+        self.xbox_xsts_expires_at = None
+
+        # the token file is shared by every process using these credentials
+        self.token_file = token_file
+        self._token_mtime = None
+
 
     def generate_new_spartan_token(self, use_refresh_token:bool=False):
+        '''Run the chain up to a new spartan token. When refreshing, levels of the chain whose tokens
+        are still valid are reused, so usually only the spartan token request is sent.'''
 
-        if use_refresh_token:
-            self.refresh_oauth_token()
-        else:
+        if not use_refresh_token:
             # get an authentication code from the user
             url = self.generate_auth_url()
             print('Navigate to the below URL, confirm permissions, and copy the "code" parameter in the return URL (starts with "M.R3_")')
             print(url)
             self.auth_code = input('Paste code...')
+            # a new login redoes the whole chain, the oauth expiry is set again by the request
+            self.oauth_expires_at = self.user_expires_at = self.halo_xsts_expires_at = self.xbox_xsts_expires_at = None
             self.request_oauth_token()
 
-        self.request_user_token()
-        self.request_xsts_token()
-        self.request_xsts_token(False)
+        # each level is only redone if it expired or the level below it was redone
+        renew_xsts = not (self.is_fresh(self.halo_xsts_expires_at) and self.is_fresh(self.xbox_xsts_expires_at))
+        renew_user = renew_xsts and not self.is_fresh(self.user_expires_at)
+        if renew_user and use_refresh_token and not self.is_fresh(self.oauth_expires_at):
+            self.refresh_oauth_token()
+
+        if renew_user:
+            self.request_user_token()
+            self.halo_xsts_expires_at = self.xbox_xsts_expires_at = None
+        if renew_xsts:
+            self.request_xsts_tokens()
         self.request_spartan_token()
 
         # finally, store the data
         self.save()
 
 
-    def load_from_json(self):
+    def load_from_json(self, quiet:bool=False):
 
         try:
-            with open('token.json') as f:
+            with open(self.token_file) as f:
+                self._token_mtime = os.fstat(f.fileno()).st_mtime_ns
                 js = json.load(f)
         except FileNotFoundError:
-            print('No "token.json" file found in the current directory.')
+            print(f'No "{self.token_file}" file found.')
             return
 
         self.auth_code = js['auth_code']
@@ -77,14 +106,20 @@ class AuthManager:
         self.spartan_token = js['spartan_token']
         self.expires_at = isoparse(js['expires_at'])
 
-        print('Loaded spartan token from file.')
+        # files saved before expiries were tracked have none, those levels are redone on the next refresh
+        self.oauth_expires_at = self._parse_expiry(js.get('oauth_expires_at'))
+        self.user_expires_at = self._parse_expiry(js.get('user_expires_at'))
+        self.halo_xsts_expires_at = self._parse_expiry(js.get('halo_xsts_expires_at'))
+        self.xbox_xsts_expires_at = self._parse_expiry(js.get('xbox_xsts_expires_at'))
+
+        if not quiet:
+            print('Loaded spartan token from file.')
 
 
     def save(self):
 
         if self.spartan_token is None:
-            print('Unable to save the authentication info without a "spartan_token" provided.')
-            exit(1)
+            raise AuthError('Unable to save the authentication info without a "spartan_token" provided.')
 
         data = {
             'client_id': self.client_id,
@@ -96,13 +131,21 @@ class AuthManager:
             'halo_xsts_token': self.halo_xsts_token,
             'xbox_xsts_token': self.xbox_xsts_token,
             'spartan_token': self.spartan_token,
-            'expires_at': self.expires_at.isoformat()
+            'expires_at': self.expires_at.isoformat(),
+            'oauth_expires_at': self._format_expiry(self.oauth_expires_at),
+            'user_expires_at': self._format_expiry(self.user_expires_at),
+            'halo_xsts_expires_at': self._format_expiry(self.halo_xsts_expires_at),
+            'xbox_xsts_expires_at': self._format_expiry(self.xbox_xsts_expires_at)
         }
 
-        with open('token.json', 'w') as f:
+        # write a temp file and swap it in so readers in other processes never see a partial file
+        tmp_file = f'{self.token_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
             json.dump(data, f)
+        os.replace(tmp_file, self.token_file)
+        self._token_mtime = os.stat(self.token_file).st_mtime_ns
 
-        print('Saved "token.json" to the current directory.')
+        print(f'Saved "{self.token_file}".')
 
 
     def token_time_remaining(self) -> float:
@@ -111,6 +154,61 @@ class AuthManager:
         return (self.expires_at - utcnow).total_seconds()
 
 
+    @staticmethod
+    def is_fresh(expires_at:dt, margin:float=CHAIN_MARGIN) -> bool:
+
+        if expires_at is None:
+            return False
+        utcnow = pytz.utc.localize(dt.utcnow())
+        return (expires_at - utcnow).total_seconds() >= margin
+
+
+    @staticmethod
+    def _parse_expiry(value:str) -> dt:
+
+        return isoparse(value) if value else None
+
+
+    @staticmethod
+    def _format_expiry(expires_at:dt) -> str:
+
+        return expires_at.isoformat() if expires_at else None
+
+
+    def get_current_spartan_token(self) -> str:
+        '''Get the spartan token, reloading the token file first if another process has replaced it.
+        Cheap enough to call per request, it's a stat call when nothing changed.'''
+
+        try:
+            mtime = os.stat(self.token_file).st_mtime_ns
+        except FileNotFoundError:
+            return self.spartan_token
+
+        if mtime != self._token_mtime:
+            self.load_from_json(quiet=True)
+        return self.spartan_token
+
+
+    def refresh_if_expiring(self, margin:float=REFRESH_MARGIN) -> bool:
+        '''Run the refresh chain if the spartan token expires within `margin` seconds, or there is none.
+
+        Single-flighted across threads and processes with a lock file next to the token file: callers
+        that waited on another refresh find the renewed token in the file and don't refresh again.
+
+        Returns:
+            bool: Whether this call refreshed the token.
+        '''
+
+        with util.locked_file(self.token_file + '.lock'):
+            self.get_current_spartan_token()
+            # without a token file yet, or an expiry, the token is treated as expiring
+            if self.spartan_token is not None and self.expires_at is not None and self.token_time_remaining() >= margin:
+                return False
+            print('Refreshing spartan token.')
+            self.generate_new_spartan_token(True)
+            return True
+
+
     def get_spartan_token(self):
 
         # if prop isn't set, try loading from file
@@ -118,10 +216,7 @@ class AuthManager:
             self.load_from_json()
 
         if self.spartan_token:
-            # refresh if less than 10 minutes remaining for token
-            if self.token_time_remaining() < 600:
-                print('Refreshing spartan token.')
-                self.generate_new_spartan_token(True)
+            self.refresh_if_expiring()
             print('Valid spartan token from file.')
             return self.spartan_token
         
@@ -165,9 +260,9 @@ class AuthManager:
         try:
             self.oauth_token = js['access_token']
         except KeyError:
-            print('No "access_token" key in the oauth token response. Response text:')
-            print(resp.text)
-            exit(1)
+            raise AuthError(f'No "access_token" key in the oauth token response. Response text: {resp.text}')
+
+        self._set_oauth_expiry(js)
 
 
     def refresh_oauth_token(self):
@@ -188,9 +283,17 @@ class AuthManager:
         try:
             self.oauth_token = js['access_token']
         except KeyError:
-            print('No "access_token" key in the oauth token response. Response text:')
-            print(resp.text)
-            exit(1)
+            raise AuthError(f'No "access_token" key in the oauth token response. Response text: {resp.text}')
+
+        self._set_oauth_expiry(js)
+
+
+    def _set_oauth_expiry(self, js:dict):
+
+        # the refresh token may be rotated with each response
+        self.refresh_token = js.get('refresh_token', self.refresh_token)
+        utcnow = pytz.utc.localize(dt.utcnow())
+        self.oauth_expires_at = utcnow + timedelta(seconds=js['expires_in']) if 'expires_in' in js else None
 
 
     def request_user_token(self):
@@ -215,11 +318,10 @@ class AuthManager:
         try:
             self.user_token = rjson['Token']
         except KeyError:
-            print('No "Token" key in the user token response. Response text:')
-            print(resp.text)
-            exit(1)
+            raise AuthError(f'No "Token" key in the user token response. Response text: {resp.text}')
 
         self.user_hash = rjson['DisplayClaims']['xui'][0]['uhs']
+        self.user_expires_at = self._parse_expiry(rjson.get('NotAfter'))
 
 
     def request_xsts_token(self, use_halo_relying_party:bool=True):
@@ -245,12 +347,21 @@ class AuthManager:
         try:
             if use_halo_relying_party:
                 self.halo_xsts_token = js['Token']
+                self.halo_xsts_expires_at = self._parse_expiry(js.get('NotAfter'))
             else:
                 self.xbox_xsts_token = js['Token']
+                self.xbox_xsts_expires_at = self._parse_expiry(js.get('NotAfter'))
         except KeyError:
-            print('No "Token" key in the xsts token response. Response text:')
-            print(resp.text)
-            exit(1)
+            raise AuthError(f'No "Token" key in the xsts token response. Response text: {resp.text}')
+
+
+    def request_xsts_tokens(self):
+        '''Request the halo and xbox XSTS tokens concurrently, they only depend on the user token.'''
+
+        with ThreadPoolExecutor(2) as executor:
+            futures = [executor.submit(self.request_xsts_token, use_halo) for use_halo in (True, False)]
+            for future in futures:
+                future.result()
 
 
     def get_xbox_live_v3_token(self):
@@ -281,9 +392,7 @@ class AuthManager:
         try:
             self.spartan_token = rjson['SpartanToken']
         except KeyError:
-            print('No "Token" key in the spartan token response. Response text:')
-            print(resp.text)
-            exit(1)
+            raise AuthError(f'No "Token" key in the spartan token response. Response text: {resp.text}')
         
         isodate = rjson['ExpiresUtc']['ISO8601Date']
         self.expires_at = isoparse(isodate)
@@ -308,7 +417,53 @@ class AuthManager:
         try:
             return rjson['FlightConfigurationId']
         except KeyError:
-            print('No "FlightConfigurationId" key in the clearance token response. Response text:')
-            print(resp.text)
-            exit(1)
+            raise AuthError(f'No "FlightConfigurationId" key in the clearance token response. Response text: {resp.text}')
+
+
+class TokenRefresher:
+    '''Background thread that renews the token chain before the spartan token expires.
+
+    Run one in the process that owns a job, pool workers (and other processes sharing the token
+    file) pick up the renewed token through AuthManager.get_current_spartan_token.'''
+
+    def __init__(self, auth_mgr:AuthManager, margin:float=REFRESH_MARGIN, check_interval:float=60):
+
+        self.auth_mgr = auth_mgr
+        self.margin = margin
+        self.check_interval = check_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def __enter__(self):
+
+        self.start()
+        return self
+
+
+    def __exit__(self, *exc_info):
+
+        self.stop()
+
+
+    def start(self):
+
+        self._thread = threading.Thread(target=self._run, name='token-refresher', daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+    def _run(self):
 
+        while not self._stop.wait(self.check_interval):
+            try:
+                self.auth_mgr.refresh_if_expiring(self.margin)
+            except Exception as e:
+                # keep going, the token may still have time left for another attempt
+                print('Spartan token refresh failed:', e)
@@ -0,0 +1,134 @@
+"""Persistent cache for API responses that never change."""
+
+
+import hashlib, json, os, sqlite3, threading, time, zlib
+
+from haloinfinite import singleflight
+
+
+class ResponseCache:
+    """Compressed response bodies stored in a SQLite file, keyed by a hash of the url and params.
+
+    SQLite handles locking between processes, so pool workers can share one cache file, and
+    lock(key) lets them coordinate so only one of them fetches a missing response. The total size of the stored bodies is capped at `max_bytes`, evicting the least
+    recently used entries first.
+    """
+
+    DEFAULT_MAX_BYTES = 1024 ** 3 # 1 GiB
+    COMPRESSION_LEVEL = 6
+
+    def __init__(self, path:str='response_cache.sqlite', max_bytes:int=DEFAULT_MAX_BYTES):
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock() # threads share the connection
+        self._key_locks = singleflight.KeyLocks(path + '.locks')
+
+    def __getstate__(self):
+
+        # connections can't cross process boundaries, workers open their own
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+
+        if self._conn is None or self._pid != os.getpid():
+            dirname = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(dirname, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS response (
+                    key text PRIMARY KEY,
+                    url text NOT NULL,
+                    body blob NOT NULL,
+                    size int NOT NULL,
+                    accessed_at real NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS response_accessed_at ON response (accessed_at)')
+            # running total of stored bytes so eviction checks don't scan the table
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (id int PRIMARY KEY CHECK (id = 0), total_size int NOT NULL)')
+            conn.execute('INSERT OR IGNORE INTO meta (id, total_size) VALUES (0, 0)')
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def make_key(url:str, params:dict=None) -> str:
+
+        # sort keys so equivalent param dicts hash the same
+        raw = json.dumps([url, params or {}], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def lock(self, key:str):
+        """Context manager holding a host-wide lock for the key."""
+
+        return self._key_locks.hold(key)
+
+    def get(self, key:str) -> bytes:
+        """Get an uncompressed response body, or None if it isn't cached."""
+
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT body FROM response WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE response SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        return zlib.decompress(row[0])
+
+    def put(self, key:str, url:str, body:bytes) -> None:
+
+        compressed = zlib.compress(body, self.COMPRESSION_LEVEL)
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT size FROM response WHERE key = ?', (key,)).fetchone()
+                conn.execute('''
+                    INSERT OR REPLACE INTO response (key, url, body, size, accessed_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (key, url, compressed, len(compressed), time.time()))
+                conn.execute('UPDATE meta SET total_size = total_size + ?', (len(compressed) - (row[0] if row else 0),))
+                self._evict(conn)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def _evict(self, conn:sqlite3.Connection) -> None:
+
+        total = conn.execute('SELECT total_size FROM meta').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # walk from the least recently used entry until enough space is freed
+        excess = total - self.max_bytes
+        keys = []
+        freed = 0
+        for key, size in conn.execute('SELECT key, size FROM response ORDER BY accessed_at'):
+            keys.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany('DELETE FROM response WHERE key = ?', keys)
+        conn.execute('UPDATE meta SET total_size = total_size - ?', (freed,))
+
+    def clear(self) -> None:
+
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM response')
+            conn.execute('UPDATE meta SET total_size = 0')
+            conn.execute('COMMIT')
@@ -0,0 +1,204 @@
+"""Long-running crawl of the player queue, keeping several players syncing at once."""
+
+
+import signal, threading, traceback
+
+from haloinfinite import aioapi, api, db, job, util
+
+
+class Crawler:
+    '''Syncs players from the queue, most overdue first, `concurrency` players at a time.
+
+    When no player is due, up to `concurrency` players discovered in fetched matches are
+    promoted from the frontier into the queue, see discovery.Discovery.
+
+    A player is probed first with a single match count request and only gets a MatchJob when
+    the count changed since the last probe. The time until the next probe halves after each
+    change and doubles after each unchanged probe, between `min_interval` and `max_interval`.
+
+    Each player's MatchJob is run from one of the crawler's threads, and fetches its pages on one
+    event loop shared by all the jobs, through one AsyncApiService made from the crawler's
+    ApiService. So the jobs share its connections, concurrency control and single flight, as well
+    as the token and rate limiter, and no player pays for process pool start-up or authentication.
+    Probes go through the crawler's ApiService itself.
+
+    Crawlers on any number of hosts can share one database. A player is leased in the database
+    for `lease_seconds` before it is synced, and the lease is renewed while the sync runs, so
+    no two crawlers sync the same player. Players of a crashed crawler, or whose sync failed,
+    are picked up by any crawler once their lease expires.
+    '''
+
+    def __init__(self, halo_api:api.ApiService, pgdb:db.Database, concurrency:int=4, max_in_flight:int=32,
+        min_interval:float=3600, max_interval:float=7 * 86400, idle_wait:float=60, promote_frontier:bool=True,
+        lease_seconds:float=300):
+        """
+        Args:
+            halo_api (ApiService): Client for the probes, the jobs' async client is configured like it.
+            pgdb (Database): Database the queue is read from and matches are written to.
+            concurrency (int): Players synced at the same time.
+            max_in_flight (int): Max page requests in flight per player.
+            min_interval (float): Shortest time between probes of a player in seconds, also the
+                interval for players never probed.
+            max_interval (float): Longest time between probes of a player in seconds.
+            idle_wait (float): Seconds to wait before checking the queue again when no player is due.
+            promote_frontier (bool): Grow the queue with discovered players when no player is due.
+            lease_seconds (float): How long a player stays leased without renewal, also the wait
+                before retrying a failed job.
+        """
+
+        self.halo_api = halo_api
+        self.db = pgdb
+        self.concurrency = concurrency
+        self.max_in_flight = max_in_flight
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.idle_wait = idle_wait
+        self.promote_frontier = promote_frontier
+        self.lease_seconds = lease_seconds
+        self.worker_id = util.worker_id()
+
+        self.jobs_completed = 0
+        self.jobs_failed = 0
+        self.players_skipped = 0 # probed with an unchanged match count
+        self._active = set() # player ids being synced, their leases are renewed
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        # set once every job has finished, leases are renewed until then even while stopping
+        self._jobs_done = threading.Event()
+        self._service_loop = None # set while running
+
+
+    def install_signal_handlers(self):
+        '''Stop on SIGINT/SIGTERM once the jobs in progress finish. Call from the main thread.'''
+
+        def handle(signum, frame):
+            print(f'\nReceived {signal.Signals(signum).name}, stopping after the {len(self._active)} jobs in progress finish...')
+            self.stop()
+
+        signal.signal(signal.SIGINT, handle)
+        signal.signal(signal.SIGTERM, handle)
+
+
+    def stop(self):
+
+        self._stopping.set()
+
+
+    def run(self):
+        '''Crawl until stopped, then wait for the jobs in progress.'''
+
+        print(f'Crawling with {self.concurrency} players at a time as {self.worker_id}.')
+
+        with aioapi.ServiceLoop(self.halo_api, self.concurrency * self.max_in_flight) as service_loop:
+            self._service_loop = service_loop
+            threads = [threading.Thread(target=self._work, name=f'crawler-{i}') for i in range(self.concurrency)]
+            for t in threads:
+                t.start()
+            self._jobs_done.clear()
+            renewer = threading.Thread(target=self._renew_leases, name='crawler-leases', daemon=True)
+            renewer.start()
+            # join with a timeout so the main thread keeps handling signals
+            for t in threads:
+                while t.is_alive():
+                    t.join(1)
+            self._jobs_done.set()
+            renewer.join()
+        self._service_loop = None
+
+        print(f'Crawler stopped, {self.jobs_completed} jobs completed, {self.jobs_failed} failed, {self.players_skipped} players unchanged.')
+
+
+    def _claim_next_player(self) -> tuple: # namedtuple
+        '''Lease the most overdue player that isn't leased by any crawler, None if no player is due.'''
+
+        player = self.db.lease_next_player(self.worker_id, self.lease_seconds, self.min_interval)
+        if player is None and self.promote_frontier and self.db.promote_frontier_players(self.concurrency):
+            player = self.db.lease_next_player(self.worker_id, self.lease_seconds, self.min_interval)
+        if player is not None:
+            with self._lock:
+                self._active.add(player.id)
+        return player
+
+
+    def _renew_leases(self):
+        '''Keep the leases of the players being synced, a few times per lease period, until every job has finished.'''
+
+        while not self._jobs_done.wait(self.lease_seconds / 3):
+            with self._lock:
+                player_ids = list(self._active)
+            try:
+                renewed = self.db.renew_leases(db.PLAYER_LEASE, player_ids, self.worker_id, self.lease_seconds)
+            except Exception:
+                # the leases are still good for a while, try again next period
+                traceback.print_exc()
+                continue
+            lost = set(player_ids) - set(renewed)
+            # a player may have finished since the ids were read
+            with self._lock:
+                lost &= self._active
+            if lost:
+                print(f'Leases expired for player ids {sorted(lost)}, they may be synced by another crawler too.')
+
+
+    def _sync_player(self, player) -> bool:
+        '''Probe the player's match count and run a MatchJob if it changed.
+
+        Returns:
+            bool: Whether a job ran.
+        '''
+
+        # this is combined matchmade, custom, and local games, individual counts are also available
+        match_count = self.halo_api.get_player_match_count(player.xuid)['MatchesPlayedCount']
+        if match_count == player.match_count:
+            interval = min(self.max_interval, 2 * player.sync_interval)
+            self.db.update_player_sync(player.id, match_count, interval, synced=False)
+            return False
+
+        job.MatchJob(player.id, self.halo_api, self.db, match_count).run_async(self.max_in_flight, service_loop=self._service_loop)
+        interval = max(self.min_interval, player.sync_interval / 2)
+        self.db.update_player_sync(player.id, match_count, interval, synced=True)
+        return True
+
+
+    def _work(self):
+
+        while not self._stopping.is_set():
+            try:
+                player = self._claim_next_player()
+            except Exception:
+                # e.g. the database is unreachable or the pool timed out, nothing is leased yet
+                print('Claiming a player failed:')
+                traceback.print_exc()
+                self._stopping.wait(self.idle_wait)
+                continue
+            if player is None:
+                self._stopping.wait(self.idle_wait)
+                continue
+
+            player_id = player.id
+            failed = False
+            synced = False
+            try:
+                synced = self._sync_player(player)
+            except Exception:
+                # the job stays invalid and the lease is left to expire, so the player is picked up
+                # again by any crawler after lease_seconds
+                print(f'Sync for player id {player_id} failed:')
+                traceback.print_exc()
+                failed = True
+            finally:
+                with self._lock:
+                    self._active.discard(player_id)
+                    if failed:
+                        self.jobs_failed += 1
+                    elif synced:
+                        self.jobs_completed += 1
+                    else:
+                        self.players_skipped += 1
+
+            if not failed:
+                # the next probe is scheduled, the player can go to whichever crawler is free then
+                try:
+                    self.db.release_leases(db.PLAYER_LEASE, [player_id], self.worker_id)
+                except Exception:
+                    traceback.print_exc()
@@ -1,10 +1,14 @@
 """Contains logic for inserting records into the database."""
 
 
-import psycopg2
+import asyncio, functools, os, psycopg2, threading, time
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 from psycopg2.extras import execute_values, NamedTupleCursor
+from psycopg2.pool import PoolError
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import Union
+from io import StringIO
+from typing import Generator, Union
 
 from haloinfinite import util
 
@@ -12,36 +16,399 @@ PROD_DB = 'halo_infinite'
 TEST_DB = 'halo_infinite_test'
 SYSTEM_DB = 'postgres'
 
+# work_lease kinds
+PLAYER_LEASE = 'player'
+MATCH_DETAILS_LEASE = 'match_details'
+
+# columns of match_staging, see Database.resolve_dimensions
+MATCH_STAGING_COLUMNS = (
+    'guid',
+    'started_at',
+    'completed_at',
+    'duration',
+    'map_version_id',
+    'mode_version_id',
+    'playlist_version_id',
+    'lifecycle_mode_id',
+    'experience_id',
+    'season_id',
+    'playable_duration'
+)
+
+# row template for create_dimensions.sql, keys are the fields from flatten.flatten_matches
+DIMENSION_TEMPLATE = '''(
+    %(map_asset_id)s,
+    %(map_version_id)s,
+    %(map_level_id)s,
+    %(game_variant_asset_id)s,
+    %(game_variant_version_id)s,
+    %(game_variant_category)s,
+    %(playlist_asset_id)s,
+    %(playlist_version_id)s,
+    %(season_id)s
+)'''
+
+# stats columns loaded from match stats, keys of the stats from flatten.flatten_match_details
+STATS_COLUMNS = (
+    'kills',
+    'deaths',
+    'assists',
+    'betrayals',
+    'suicides',
+    'spawns',
+    'max_killing_spree',
+    'vehicles_destroyed',
+    'vehicles_hijacked',
+    'medals',
+    'damage_dealt',
+    'damage_taken',
+    'shots_fired',
+    'shots_landed',
+    'rounds_won',
+    'rounds_lost',
+    'rounds_tied',
+    'melee_kills',
+    'grenade_kills',
+    'headshot_kills',
+    'power_weapon_kills',
+    'emp_assists',
+    'driver_assists',
+    'callout_assists',
+    'score_personal',
+    'score_points',
+    'participation_confirmed',
+    'joined_in_progress',
+    'joined_at',
+    'left_at',
+    'present_at_beginning',
+    'present_at_completion',
+    'outcome_id',
+    'rank'
+)
+
+
+class ConnectionPool:
+    """Connections of one process to one database, shared by its threads.
+
+    getconn blocks while `max_connections` are checked out, and raises PoolError if none is
+    returned within `checkout_timeout` seconds, e.g. when the threads holding them all wait for
+    another connection. A connection idle for longer than `health_check_interval` seconds is
+    checked with a round trip before it is handed out, and replaced if it's broken, e.g. after
+    a server restart.
+    """
+
+    def __init__(self, connect_kwargs:dict, min_connections:int=1, max_connections:int=10, health_check_interval:float=30,
+        checkout_timeout:float=60):
+
+        self.connect_kwargs = connect_kwargs
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+        self._idle = [] # (connection, monotonic time it was returned)
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+
+        for _ in range(min_connections):
+            self._idle.append((self._open(), time.monotonic()))
+
+    def _open(self):
+
+        return psycopg2.connect(**self.connect_kwargs)
+
+    def _is_healthy(self, conn, idle_since:float) -> bool:
+
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise PoolError(f'No connection was returned to the pool within {self.checkout_timeout} seconds, all {self.max_connections} are checked out')
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    return self._open()
+                conn, idle_since = item
+                if self._is_healthy(conn, idle_since):
+                    return conn
+                conn.close()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, discard:bool=False) -> None:
+        """Return a connection, rolling back what wasn't committed. Broken or discarded connections are closed."""
+
+        try:
+            if not conn.closed and not discard:
+                try:
+                    if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+                else:
+                    with self._lock:
+                        self._idle.append((conn, time.monotonic()))
+                    return
+            if not conn.closed:
+                conn.close()
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        """Close the idle connections, checked out ones are closed when returned."""
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+
+class _UnitOfWorkConnection:
+    """Connection lent to Database methods called inside Database.transaction, their commits are
+    left to the transaction."""
+
+    def __init__(self, conn):
+
+        self._conn = conn
+
+    def commit(self):
+
+        pass
+
+    def __getattr__(self, name:str):
+
+        return getattr(self._conn, name)
+
+
+# pools and async executors of this process, keyed by pid first so forked children open their own
+# connections instead of sharing the parent's sockets
+_pools = {}
+_executors = {}
+_pools_lock = threading.Lock()
+# per thread, pool key: connection of the transaction in progress
+_local = threading.local()
+
+
+def _to_copy_text(value) -> str:
+    """Format a value for COPY's text format."""
+
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class DimensionCache:
+    """Ids of the map, mode and playlist versions and of the seasons, keyed like in flattened
+    matches: by asset and version id, seasons by name.
+
+    There are a few hundred of them for millions of matches, so matches are written with their
+    ids resolved here instead of being looked up in the database for every batch.
+    """
+
+    def __init__(self):
+
+        self.map_versions = {} # (asset_id, version_id): map_version.id
+        self.mode_versions = {} # (asset_id, version_id): mode_version.id
+        self.playlist_versions = {} # (asset_id, version_id): playlist_version.id
+        self.seasons = {} # name: season.id
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def update(self, map_versions:dict, mode_versions:dict, playlist_versions:dict, seasons:dict) -> None:
+
+        # replaced, not mutated, so resolve never sees a dict change size mid-lookup
+        with self._lock:
+            self.map_versions = map_versions
+            self.mode_versions = mode_versions
+            self.playlist_versions = playlist_versions
+            self.seasons = seasons
+            self.loaded = True
+
+    def resolve(self, match:dict) -> tuple:
+        """Get the ids of a flattened match's dimensions.
+
+        Returns:
+            tuple: map_version, mode_version, playlist_version and season ids, or None if any isn't cached.
+        """
+
+        map_version_id = self.map_versions.get((match['map_asset_id'], match['map_version_id']))
+        mode_version_id = self.mode_versions.get((match['game_variant_asset_id'], match['game_variant_version_id']))
+        if map_version_id is None or mode_version_id is None:
+            return None
+
+        # playlist and season can be null
+        playlist_version_id = None
+        if match['playlist_asset_id'] is not None:
+            playlist_version_id = self.playlist_versions.get((match['playlist_asset_id'], match['playlist_version_id']))
+            if playlist_version_id is None:
+                return None
+        season_id = None
+        if match['season_id'] is not None:
+            season_id = self.seasons.get(match['season_id'])
+            if season_id is None:
+                return None
+
+        return map_version_id, mode_version_id, playlist_version_id, season_id
+
 
 class Database:
-    def __init__(self, db_name:str=PROD_DB):
+    def __init__(self, db_name:str=PROD_DB, min_connections:int=1, max_connections:int=10,
+        statement_timeout:float=None, health_check_interval:float=30, checkout_timeout:float=60):
+        """
+        Args:
+            db_name (str): Key of the database in the config file.
+            min_connections (int): Connections opened with the pool, per process.
+            max_connections (int): Most connections in use at once per process, more callers wait.
+            statement_timeout (float): Seconds before the server cancels a statement, no limit by default.
+            health_check_interval (float): Seconds a connection can sit idle before it's checked on checkout.
+            checkout_timeout (float): Seconds to wait for a pooled connection before raising PoolError.
+        """
 
         db_cfg = util.load_config()['database'][db_name]
         self.host = db_cfg['host']
         self.name = db_cfg['name']
         self.user = db_cfg['user']
         self.password = db_cfg['password']
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.statement_timeout = statement_timeout
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+        self.dimensions = DimensionCache()
+
+    def _pool_key(self) -> tuple:
+
+        return (self.host, self.name, self.user, self.min_connections, self.max_connections,
+            self.statement_timeout, self.health_check_interval, self.checkout_timeout)
+
+    def get_pool(self) -> ConnectionPool:
+        """Get the connection pool of this process, creating it on first use."""
+
+        key = (os.getpid(),) + self._pool_key()
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                connect_kwargs = {'host': self.host, 'dbname': self.name, 'user': self.user, 'password': self.password}
+                if self.statement_timeout is not None:
+                    connect_kwargs['options'] = f'-c statement_timeout={int(self.statement_timeout * 1000)}'
+                pool = ConnectionPool(connect_kwargs, self.min_connections, self.max_connections, self.health_check_interval,
+                    self.checkout_timeout)
+                _pools[key] = pool
+        return pool
+
+    def close(self) -> None:
+        """Close this process's idle connections to the database."""
+
+        key = (os.getpid(),) + self._pool_key()
+        with _pools_lock:
+            pool = _pools.pop(key, None)
+        if pool is not None:
+            pool.close()
+
+    @contextmanager
+    def _checkout(self):
+
+        pool = self.get_pool()
+        conn = pool.getconn()
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # the connection may be broken
+            discard = True
+            raise
+        finally:
+            pool.putconn(conn, discard)
 
     @contextmanager
-    def connect(self):
-        """Create a contextual database connection.
+    def connect(self, join:bool=True):
+        """Check out a pooled connection, what isn't committed is rolled back when it's returned.
+
+        Args:
+            join (bool): Inside a transaction, use its connection and leave committing to it.
+                Pass False for work that must commit on its own.
 
         Yields:
             Connection: The database connection engine.
         """
-        
-        conn = psycopg2.connect(
-            host=self.host,
-            dbname=self.name,
-            user=self.user,
-            password=self.password
-        )
-        try:
+
+        units = getattr(_local, 'units', {})
+        conn = units.get(self._pool_key()) if join else None
+        if conn is not None:
+            yield _UnitOfWorkConnection(conn)
+            return
+
+        with self._checkout() as conn:
             yield conn
-        # except Exception as e:
-        #     print(f'Error connecting to database:\n{e}')
-        finally:
-            conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Run several Database calls as one unit of work, on one connection and in one transaction
+        that commits when the block exits and rolls back if it raises. Nested transactions join
+        the outer one.
+
+            with pgdb.transaction():
+                job_id = pgdb.create_job('match')
+                pgdb.create_job_player(job_id, player_id)
+
+        Yields:
+            Connection: The connection of the transaction.
+        """
+
+        if not hasattr(_local, 'units'):
+            _local.units = {}
+        key = self._pool_key()
+        if key in _local.units:
+            yield _UnitOfWorkConnection(_local.units[key])
+            return
+
+        with self._checkout() as conn:
+            _local.units[key] = conn
+            try:
+                yield _UnitOfWorkConnection(conn)
+                conn.commit()
+            finally:
+                # the checkout rolls back if the block raised
+                del _local.units[key]
+
+    async def run_async(self, func, *args, **kwargs):
+        """Await a blocking Database call, e.g. `await pgdb.run_async(pgdb.create_job, 'match')`.
+
+        The call runs on a thread of this process's executor, which has one thread per pooled
+        connection, so the event loop keeps running and calls never wait on the pool.
+        """
+
+        key = (os.getpid(),) + self._pool_key()
+        with _pools_lock:
+            executor = _executors.get(key)
+            if executor is None:
+                executor = ThreadPoolExecutor(self.max_connections, thread_name_prefix='db')
+                _executors[key] = executor
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args, **kwargs))
 
     def execute_script(self, file_name:str) -> None:
         """Execute the SQL content of a file.
@@ -82,6 +449,9 @@ class Database:
         if self.name == PROD_DB and input(prompt).lower().strip() != 'y':
             exit()
             
+        # pooled connections would keep the database from being dropped
+        self.close()
+
         sys_conn = psycopg2.connect(
             host=self.host,
             dbname=SYSTEM_DB,
@@ -142,8 +512,14 @@ class Database:
                 CREATE TEMP TABLE tmp (xuid text);
                 INSERT INTO tmp (xuid) VALUES (%s);
 
-                INSERT INTO player (xuid)
-                SELECT xuid
+                -- a player already seen in loaded match stats joins the queue
+                UPDATE player
+                SET in_queue = true
+                FROM tmp
+                WHERE player.xuid = tmp.xuid;
+
+                INSERT INTO player (xuid, in_queue)
+                SELECT xuid, true
                 FROM tmp
                 WHERE NOT EXISTS (SELECT 1 FROM player WHERE xuid = tmp.xuid)
                 RETURNING id;
@@ -198,28 +574,134 @@ class Database:
             ''', (player_id,))
             return cur.fetchone()
 
+    def _copy(self, cur, table:str, columns:tuple, rows:list[tuple]) -> None:
+        """Stream rows into a table with COPY, much faster than inserts for large batches."""
+
+        buf = StringIO()
+        for row in rows:
+            buf.write('\t'.join(map(_to_copy_text, row)))
+            buf.write('\n')
+        buf.seek(0)
+        cur.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN', buf)
+
+
+    def load_dimensions(self) -> None:
+        """Load the ids of every map, mode and playlist version and season into the dimension cache, e.g. at job start."""
+
+        with self.connect() as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                SELECT m.asset_id, mv.version_id, mv.id
+                FROM map_version mv
+                JOIN map m ON m.id = mv.map_id
+            ''')
+            map_versions = {(asset_id, version_id): id for asset_id, version_id, id in cur.fetchall()}
+            cur.execute('''
+                SELECT m.asset_id, mv.version_id, mv.id
+                FROM mode_version mv
+                JOIN mode m ON m.id = mv.mode_id
+            ''')
+            mode_versions = {(asset_id, version_id): id for asset_id, version_id, id in cur.fetchall()}
+            cur.execute('''
+                SELECT p.asset_id, pv.version_id, pv.id
+                FROM playlist_version pv
+                JOIN playlist p ON p.id = pv.playlist_id
+            ''')
+            playlist_versions = {(asset_id, version_id): id for asset_id, version_id, id in cur.fetchall()}
+            cur.execute('SELECT name, id FROM season')
+            seasons = dict(cur.fetchall())
+
+        self.dimensions.update(map_versions, mode_versions, playlist_versions, seasons)
+
+
+    def resolve_dimensions(self, matches:list[dict]) -> list[tuple]:
+        """Get the match_staging rows of flattened matches, with their dimensions resolved to ids.
+
+        Maps, modes, playlists, seasons and versions missing from the cache are inserted in bulk
+        and the cache is reloaded.
+        """
+
+        if not self.dimensions.loaded:
+            self.load_dimensions()
+
+        resolved = [self.dimensions.resolve(m) for m in matches]
+        missing = [m for m, ids in zip(matches, resolved) if ids is None]
+        if missing:
+            # committed on its own, even inside a transaction, so the cache never holds ids of rows
+            # that were rolled back
+            with self.connect(join=False) as conn:
+                cur = conn.cursor()
+                # one page, the script creates its temp table once
+                execute_values(cur, util.get_package_data('sql/create_dimensions.sql'), missing, DIMENSION_TEMPLATE, page_size=len(missing))
+                conn.commit()
+            self.load_dimensions()
+            resolved = [self.dimensions.resolve(m) for m in matches]
+
+        rows = []
+        for m, ids in zip(matches, resolved):
+            if ids is None:
+                raise ValueError(f'Could not resolve the map, mode, playlist or season of match {m["guid"]}')
+            map_version_id, mode_version_id, playlist_version_id, season_id = ids
+            rows.append((
+                m['guid'],
+                m['started_at'],
+                m['completed_at'],
+                m['duration'],
+                map_version_id,
+                mode_version_id,
+                playlist_version_id,
+                m['lifecycle_mode_id'],
+                m['experience_id'],
+                season_id,
+                m['playable_duration']
+            ))
+        return rows
+
+
+    def _create_matches(self, cur, rows:list[tuple]) -> list[int]:
+
+        # stage the whole batch with one COPY, then insert it with one statement
+        self._copy(cur, 'match_staging', MATCH_STAGING_COLUMNS, rows)
+        cur.execute(util.get_package_data('sql/create_matches.sql'))
+        match_ids = [r[0] for r in cur.fetchall()]
+        cur.execute('DELETE FROM match_staging')
+        return match_ids
+
+
     def create_matches(self, matches:list[dict]) -> list[int]:
+        """Insert flattened matches, in batches of any size.
+
+        Returns:
+            list[int]: Ids of the matches that weren't already in the database.
+        """
+
+        # before checking out a connection, resolving may need connections of its own
+        rows = self.resolve_dimensions(matches)
+        with self.connect() as conn:
+            cur = conn.cursor()
+            match_ids = self._create_matches(cur, rows)
+            conn.commit()
+            return match_ids
+
 
-        template = '''(
-            %(guid)s,
-            %(started_at)s,
-            %(completed_at)s,
-            %(duration)s,
-            %(map_asset_id)s,
-            %(map_version_id)s,
-            %(map_level_id)s,
-            %(game_variant_asset_id)s,
-            %(game_variant_version_id)s,
-            %(game_variant_category)s,
-            %(playlist_asset_id)s,
-            %(playlist_version_id)s,
-            %(lifecycle_mode_id)s,
-            %(experience_id)s,
-            %(season_id)s,
-            %(playable_duration)s
-        )'''
-        rows = self.execute_values_with_file('create_matches.sql', matches, template, fetch=True)
-        return [r[0] for r in rows]
+    def create_job_matches_from(self, job_id:int, matches:list[dict]) -> list[int]:
+        """Insert matches and link the new ones to the job, in one transaction on one connection.
+
+        Args:
+            job_id (int): The job that retrieved the matches.
+            matches (list[dict]): Flattened matches.
+
+        Returns:
+            list[int]: Ids of the matches that weren't already in the database.
+        """
+
+        rows = self.resolve_dimensions(matches)
+        with self.connect() as conn:
+            cur = conn.cursor()
+            match_ids = self._create_matches(cur, rows)
+            self._copy(cur, 'job_match', ('job_id', 'match_id'), [(job_id, mid) for mid in match_ids])
+            conn.commit()
+            return match_ids
 
 
     def create_job_matches(self, job_id:int, match_ids:list[int]) -> None:
@@ -233,6 +715,114 @@ class Database:
         self.execute_values_with_str(sql, values, template)
 
 
+    def _get_or_create_ids(self, cur, table:str, column:str, keys:set) -> dict:
+        """Insert the keys missing from a table with a unique key column.
+
+        Returns:
+            dict: Key: id, for every key.
+        """
+
+        if not keys:
+            return {}
+
+        # sorted so loaders creating the same keys at once lock them in the same order
+        keys = sorted(keys)
+        execute_values(cur, f'''
+            INSERT INTO {table} ({column})
+            VALUES %s
+            ON CONFLICT ({column}) DO NOTHING
+        ''', [(k,) for k in keys], page_size=len(keys))
+        cur.execute(f'SELECT {column}, id FROM {table} WHERE {column} = ANY(%s)', (keys,))
+        return dict(cur.fetchall())
+
+
+    def _reserve_ids(self, cur, table:str, count:int) -> list[int]:
+        """Take `count` ids from the sequence of a table's serial id, for rows inserted with explicit ids.
+
+        The ids are unique across concurrent callers but not necessarily contiguous.
+        """
+
+        cur.execute('''
+            SELECT nextval(pg_get_serial_sequence(%s, 'id'))
+            FROM generate_series(1, %s)
+        ''', (table, count))
+        return [r[0] for r in cur.fetchall()]
+
+
+    def create_match_details(self, details:list[dict]) -> int:
+        """Load the teams, players, bots, stats and medals of matches in one transaction, with one
+        statement per table, and mark the matches as loaded.
+
+        Players, bots and medals not in the database yet are created, players outside the crawl
+        queue, see promote_frontier_players. Matches already loaded, e.g.
+        by a worker whose lease expired, are skipped.
+
+        Args:
+            details (list[dict]): Match details from flatten.flatten_match_details, guids must be unique within the list.
+
+        Returns:
+            int: The number of matches loaded.
+        """
+
+        with self.connect() as conn:
+            cur = conn.cursor()
+            # row locks hold off other loaders of the same matches until this commits
+            cur.execute('''
+                SELECT guid, id
+                FROM match
+                WHERE guid = ANY(%s) AND details_loaded_at IS NULL
+                ORDER BY id
+                FOR UPDATE
+            ''', ([d['guid'] for d in details],))
+            match_ids = dict(cur.fetchall())
+            details = [d for d in details if d['guid'] in match_ids]
+            if not details:
+                conn.commit()
+                return 0
+
+            player_ids = self._get_or_create_ids(cur, 'player', 'xuid', {p['id'] for d in details for p in d['players']})
+            bot_ids = self._get_or_create_ids(cur, 'bot', 'bid', {b['id'] for d in details for b in d['bots']})
+            medal_ids = self._get_or_create_ids(cur, 'medal', 'api_id',
+                {m['id'] for d in details for o in d['teams'] + d['players'] + d['bots'] for m in o['medals']})
+
+            # stats of every team, player and bot, with ids taken up front so the rows referencing
+            # them are built here and every table is written in one pass, without RETURNING
+            owners = [(d, kind, o) for d in details for kind in ('teams', 'players', 'bots') for o in d[kind]]
+            stats_ids = self._reserve_ids(cur, 'stats', len(owners))
+
+            stats, teams, players, bots, medals = [], [], [], [], []
+            for (d, kind, o), stats_id in zip(owners, stats_ids):
+                stats.append((stats_id, *(o['stats'][c] for c in STATS_COLUMNS)))
+                match_id = match_ids[d['guid']]
+                if kind == 'teams':
+                    teams.append((match_id, o['id'], stats_id))
+                elif kind == 'players':
+                    players.append((match_id, player_ids[o['id']], o['team_id'], stats_id))
+                else:
+                    bots.append((match_id, bot_ids[o['id']], o['team_id'], o['difficulty_id'], stats_id))
+                medals.extend((stats_id, medal_ids[m['id']], m['count']) for m in o['medals'])
+
+            # the matches are locked, so the rows can't exist yet and are copied without merging
+            self._copy(cur, 'stats', ('id',) + STATS_COLUMNS, stats)
+            self._copy(cur, 'match_team', ('match_id', 'team_id', 'stats_id'), teams)
+            self._copy(cur, 'match_player', ('match_id', 'player_id', 'team_id', 'stats_id'), players)
+            self._copy(cur, 'match_bot', ('match_id', 'bot_id', 'team_id', 'bot_difficulty_id', 'stats_id'), bots)
+            self._copy(cur, 'stats_medal', ('stats_id', 'medal_id', 'count'), medals)
+
+            loaded_ids = [match_ids[d['guid']] for d in details]
+            cur.execute('''
+                UPDATE match
+                SET details_loaded_at = now()
+                WHERE id = ANY(%s)
+            ''', (loaded_ids,))
+            cur.execute('''
+                DELETE FROM work_lease
+                WHERE kind = %s AND item_id = ANY(%s)
+            ''', (MATCH_DETAILS_LEASE, loaded_ids))
+            conn.commit()
+            return len(details)
+
+
     def get_playlist_versions(self) -> list[tuple]: # namedtuple
 
         with self.connect() as conn:
@@ -364,7 +954,80 @@ class Database:
             conn.commit()
 
 
-    def get_next_player_in_queue(self) -> tuple: # namedtuple
+    def get_known_xuids(self) -> Generator:
+        """Iterate over the xuids of every queued player and frontier entry, streamed from a server side cursor."""
+
+        with self.connect() as conn:
+            cur = conn.cursor('known_xuids')
+            cur.itersize = 10000
+            cur.execute('''
+                SELECT xuid FROM player WHERE in_queue
+                UNION ALL
+                SELECT xuid FROM player_frontier
+            ''')
+            for row in cur:
+                yield row[0]
+
+
+    def create_frontier_players(self, xuids:list[str]) -> int:
+        """Add discovered xuids to the frontier, skipping ones already there or in the crawl queue.
+        Players only seen in loaded match stats are in the player table but not queued, so they're added.
+
+        Returns:
+            int: The number of xuids added.
+        """
+
+        sql = '''
+            INSERT INTO player_frontier (xuid)
+            SELECT v.xuid
+            FROM (VALUES %s) AS v (xuid)
+            WHERE NOT EXISTS (SELECT 1 FROM player WHERE xuid = v.xuid AND in_queue)
+            ON CONFLICT (xuid) DO NOTHING
+        '''
+        values = [{'xuid': util.unwrap_xuid(x)} for x in xuids]
+        return self.execute_values_with_str(sql, values, '(%(xuid)s)', page_size=max(1, len(values)))
+
+
+    def promote_frontier_players(self, limit:int) -> int:
+        """Move the longest waiting frontier xuids into the crawl queue, creating their players or
+        queueing the ones already created by loaded match stats.
+
+        Returns:
+            int: The number of players queued.
+        """
+
+        with self.connect() as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                WITH promoted AS (
+                    UPDATE player_frontier
+                    SET promoted_at = now()
+                    WHERE xuid IN (
+                        SELECT xuid
+                        FROM player_frontier
+                        WHERE promoted_at IS NULL
+                        ORDER BY discovered_at
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED -- crawlers promoting at the same time take different xuids
+                    )
+                    RETURNING xuid
+                )
+                INSERT INTO player (xuid, in_queue)
+                SELECT xuid, true
+                FROM promoted
+                ON CONFLICT (xuid) DO UPDATE
+                SET in_queue = true
+            ''', (limit,))
+            conn.commit()
+            return cur.rowcount
+
+
+    def get_next_player_in_queue(self, exclude_ids:list[int]=None) -> tuple: # namedtuple
+        """Get the player whose last valid job is the oldest, players never synced first.
+
+        Args:
+            exclude_ids (list[int]): Players to skip, e.g. ones already being synced.
+        """
 
         with self.connect() as conn:
             cur = conn.cursor(cursor_factory=NamedTupleCursor)
@@ -372,12 +1035,193 @@ class Database:
                 SELECT p.id, max(j.created_at) AS last_job_at
                 FROM player p
                 LEFT JOIN job_player jp ON jp.player_id = p.id
-                LEFT JOIN job j ON j.id = jp.job_id
-                LEFT JOIN job_match jm ON j.id = jm.job_id
-                WHERE j.is_valid
+                -- filter in the join so players without a valid job are kept, with a null last_job_at
+                LEFT JOIN job j ON j.id = jp.job_id AND j.is_valid
+                WHERE p.in_queue AND p.id <> ALL(%s::int[])
                 GROUP BY p.id
                 ORDER BY 2 ASC NULLS FIRST -- make it explicit that we are getting unprocessed players first, then the oldest valid job for the player
                 LIMIT 1 -- only need to return one player per call
-            ''')
+            ''', (list(exclude_ids or []),))
             return cur.fetchone()
+
+
+    def lease_next_player(self, owner:str, lease_seconds:float, default_interval:float, exclude_ids:list[int]=None) -> tuple: # namedtuple
+        """Lease the player whose next probe is the most overdue, players never probed first.
+
+        Players leased by another worker are skipped until the lease expires, so workers on any
+        number of hosts sharing the database never sync the same player at once, and players held
+        by a crashed worker are picked up again once its lease runs out.
+
+        Args:
+            owner (str): Worker taking the lease, see util.worker_id.
+            lease_seconds (float): Seconds until the lease expires unless renewed, see renew_leases.
+            default_interval (float): Seconds between probes for players without a sync state.
+            exclude_ids (list[int]): Players to skip.
+
+        Returns:
+            namedtuple: id, xuid, match_count (None if never probed) and sync_interval, or None if no player is due.
+        """
+
+        with self.connect() as conn:
+            cur = conn.cursor(cursor_factory=NamedTupleCursor)
+            cur.execute('''
+                WITH candidate AS (
+                    SELECT p.id
+                    FROM player p
+                    LEFT JOIN player_sync ps ON ps.player_id = p.id
+                    LEFT JOIN work_lease wl ON wl.kind = %(kind)s AND wl.item_id = p.id
+                    WHERE p.in_queue
+                        AND p.id <> ALL(%(exclude_ids)s::int[])
+                        AND (ps.next_probe_at IS NULL OR ps.next_probe_at <= now())
+                        AND (wl.expires_at IS NULL OR wl.expires_at < now())
+                    ORDER BY ps.next_probe_at ASC NULLS FIRST
+                    LIMIT 1
+                    FOR UPDATE OF p SKIP LOCKED -- workers leasing at the same time take different players
+                ),
+                leased AS (
+                    INSERT INTO work_lease (kind, item_id, leased_by, expires_at)
+                    SELECT %(kind)s, id, %(owner)s, now() + %(lease_seconds)s * interval '1 second'
+                    FROM candidate
+                    -- only take over expired leases, a lease committed since the candidate was read wins
+                    ON CONFLICT (kind, item_id) DO UPDATE
+                    SET leased_by = excluded.leased_by, expires_at = excluded.expires_at
+                    WHERE work_lease.expires_at < now()
+                    RETURNING item_id
+                )
+                SELECT p.id, p.xuid, ps.match_count, coalesce(ps.sync_interval, %(default_interval)s) AS sync_interval
+                FROM leased
+                JOIN player p ON p.id = leased.item_id
+                LEFT JOIN player_sync ps ON ps.player_id = p.id
+            ''', {
+                'kind': PLAYER_LEASE,
+                'owner': owner,
+                'lease_seconds': lease_seconds,
+                'default_interval': default_interval,
+                'exclude_ids': list(exclude_ids or [])
+            })
+            player = cur.fetchone()
+            conn.commit()
+            return player
+
+
+    def lease_matches_without_details(self, owner:str, lease_seconds:float, limit:int, exclude_ids:list[int]=None) -> list[tuple]: # namedtuple
+        """Lease up to `limit` matches whose stats haven't been loaded, oldest first.
+
+        See lease_next_player for how leases are shared between workers.
+
+        Args:
+            exclude_ids (list[int]): Matches to skip, e.g. ones the worker already failed to load.
+
+        Returns:
+            list[namedtuple]: id and guid of the leased matches.
+        """
+
+        with self.connect() as conn:
+            cur = conn.cursor(cursor_factory=NamedTupleCursor)
+            cur.execute('''
+                WITH candidate AS (
+                    SELECT m.id
+                    FROM match m
+                    LEFT JOIN work_lease wl ON wl.kind = %(kind)s AND wl.item_id = m.id
+                    WHERE m.details_loaded_at IS NULL
+                        AND m.id <> ALL(%(exclude_ids)s::int[])
+                        AND (wl.expires_at IS NULL OR wl.expires_at < now())
+                    ORDER BY m.id
+                    LIMIT %(limit)s
+                    FOR UPDATE OF m SKIP LOCKED
+                ),
+                leased AS (
+                    INSERT INTO work_lease (kind, item_id, leased_by, expires_at)
+                    SELECT %(kind)s, id, %(owner)s, now() + %(lease_seconds)s * interval '1 second'
+                    FROM candidate
+                    ON CONFLICT (kind, item_id) DO UPDATE
+                    SET leased_by = excluded.leased_by, expires_at = excluded.expires_at
+                    WHERE work_lease.expires_at < now()
+                    RETURNING item_id
+                )
+                SELECT m.id, m.guid
+                FROM leased
+                JOIN match m ON m.id = leased.item_id
+                ORDER BY m.id
+            ''', {
+                'kind': MATCH_DETAILS_LEASE,
+                'owner': owner,
+                'lease_seconds': lease_seconds,
+                'limit': limit,
+                'exclude_ids': list(exclude_ids or [])
+            })
+            matches = cur.fetchall()
+            conn.commit()
+            return matches
+
+
+    def renew_leases(self, kind:str, item_ids:list[int], owner:str, lease_seconds:float) -> list[int]:
+        """Extend the owner's leases, call well within `lease_seconds` while the work is in progress.
+
+        Returns:
+            list[int]: The items still leased by the owner. Others expired and may have been taken over.
+        """
+
+        if not item_ids:
+            return []
+
+        with self.connect() as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                UPDATE work_lease
+                SET expires_at = now() + %s * interval '1 second'
+                WHERE kind = %s AND item_id = ANY(%s::int[]) AND leased_by = %s
+                RETURNING item_id
+            ''', (lease_seconds, kind, list(item_ids), owner))
+            renewed = [row[0] for row in cur.fetchall()]
+            conn.commit()
+            return renewed
+
+
+    def release_leases(self, kind:str, item_ids:list[int], owner:str) -> None:
+        """Give up the owner's leases once the work is done, leases taken over by others are kept."""
+
+        if not item_ids:
+            return
+
+        with self.connect() as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                DELETE FROM work_lease
+                WHERE kind = %s AND item_id = ANY(%s::int[]) AND leased_by = %s
+            ''', (kind, list(item_ids), owner))
+            conn.commit()
+
+
+    def update_player_sync(self, player_id:int, match_count:int, sync_interval:float, synced:bool) -> None:
+        """Record a probe of the player's match count and schedule the next one.
+
+        Args:
+            player_id (int): The probed player.
+            match_count (int): MatchesPlayedCount returned by the probe.
+            sync_interval (float): Seconds until the next probe.
+            synced (bool): Whether matches were retrieved after the probe.
+        """
+
+        with self.connect() as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                INSERT INTO player_sync (player_id, match_count, probed_at, synced_at, sync_interval, next_probe_at)
+                VALUES (
+                    %(player_id)s,
+                    %(match_count)s,
+                    now(),
+                    CASE WHEN %(synced)s THEN now() END,
+                    %(sync_interval)s,
+                    now() + %(sync_interval)s * interval '1 second'
+                )
+                ON CONFLICT (player_id) DO UPDATE
+                SET
+                    match_count = excluded.match_count,
+                    probed_at = excluded.probed_at,
+                    synced_at = coalesce(excluded.synced_at, player_sync.synced_at),
+                    sync_interval = excluded.sync_interval,
+                    next_probe_at = excluded.next_probe_at
+            ''', {'player_id': player_id, 'match_count': match_count, 'sync_interval': sync_interval, 'synced': synced})
+            conn.commit()
         
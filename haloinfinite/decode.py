@@ -0,0 +1,91 @@
+"""Pluggable JSON decoding of raw API response bodies."""
+
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+
+def _loads_json(body:bytes):
+
+    # json.loads accepts bytes and detects the encoding itself
+    return json.loads(body)
+
+
+def _loads_orjson(body:bytes):
+
+    return orjson.loads(body)
+
+
+def _loads_simdjson(body:bytes):
+
+    # recursive builds plain dicts and lists up front, like the other eager backends
+    return simdjson.Parser().parse(body, recursive=True)
+
+
+def _loads_lazy(body:bytes):
+    """Parse to simdjson proxies that only build Python objects for the fields that are read,
+    e.g. the handful of MatchInfo fields the flatten functions pull out of a match page."""
+
+    # each document keeps its own parser alive, a reused parser would invalidate earlier documents
+    return simdjson.Parser().parse(body)
+
+
+BACKENDS = {
+    'json': _loads_json,
+    'orjson': _loads_orjson,
+    'simdjson': _loads_simdjson,
+    'lazy': _loads_lazy
+}
+
+
+def available_backends() -> list[str]:
+
+    names = ['json']
+    if orjson is not None:
+        names.append('orjson')
+    if simdjson is not None:
+        names.extend(['simdjson', 'lazy'])
+    return names
+
+
+def resolve_backend(backend:str='auto') -> str:
+    """Get the name of the backend to use.
+
+    Args:
+        backend (str): One of BACKENDS, or "auto" for the fastest eager decoder installed.
+
+    Returns:
+        str: The backend name, falling back to "json" if the requested library isn't installed.
+    """
+
+    if backend == 'auto':
+        return 'orjson' if orjson is not None else 'simdjson' if simdjson is not None else 'json'
+
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown JSON decoder backend "{backend}", expected one of {list(BACKENDS)}')
+
+    if backend not in available_backends():
+        print(f'The library for the "{backend}" JSON decoder is not installed, using the standard library decoder.')
+        return 'json'
+
+    return backend
+
+
+def loads(body:bytes, backend:str='json'):
+    """Decode a raw response body without first decoding it to a str.
+
+    Args:
+        body (bytes): The response body.
+        backend (str): A name returned by resolve_backend.
+    """
+
+    return BACKENDS[backend](body)
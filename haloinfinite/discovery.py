@@ -0,0 +1,120 @@
+"""Snowball discovery of players from the matches the crawl fetches."""
+
+
+import hashlib, math, threading
+
+from haloinfinite import db, util
+
+
+class BloomFilter:
+    """Set membership in a fixed amount of memory, with false positives at about `error_rate`
+    once `capacity` items were added, and no false negatives."""
+
+    def __init__(self, capacity:int, error_rate:float=0.001):
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)) # bits
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray(math.ceil(self.size / 8))
+
+    def _positions(self, item:str):
+
+        # double hashing, two 64 bit halves of one digest stand in for hash_count hash functions
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def __contains__(self, item:str) -> bool:
+
+        return all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+    def add(self, item:str) -> bool:
+        """Add an item.
+
+        Returns:
+            bool: Whether the item was new, False for items added before and for false positives.
+        """
+
+        new = False
+        for p in self._positions(item):
+            mask = 1 << (p & 7)
+            if not self._bits[p >> 3] & mask:
+                self._bits[p >> 3] |= mask
+                new = True
+        self.count += new
+        return new
+
+
+class Discovery:
+    '''Collects the xuids of players seen in fetched matches into the player_frontier table,
+    from which the crawler promotes them into the player queue.
+
+    Xuids already seen by this process are dropped in memory by a Bloom filter, seeded with the
+    queued players and frontier entries already in the database, so the database only sees each new
+    xuid once, in bulk inserts of `batch_size`. A false positive drops a new player, at about
+    `error_rate` of them. They are still found if another process sees them.
+    '''
+
+    def __init__(self, pgdb:db.Database, capacity:int=1_000_000, error_rate:float=0.001, batch_size:int=1000):
+
+        self.db = pgdb
+        self.batch_size = batch_size
+        self.seen = BloomFilter(capacity, error_rate)
+        self.discovered = 0
+        self._pending = []
+        self._lock = threading.Lock()
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, *exc_info):
+
+        self.flush()
+
+
+    def load_known(self) -> None:
+        '''Seed the filter with the xuids already in the crawl queue or the player_frontier table.'''
+
+        for xuid in self.db.get_known_xuids():
+            self.seen.add(xuid)
+        print(f'Loaded {self.seen.count} known players into the discovery filter.')
+
+
+    def observe(self, xuids:list[str]) -> None:
+        '''Record xuids seen in a match, wrapped or not.'''
+
+        batch = None
+        with self._lock:
+            for xuid in xuids:
+                xuid = util.unwrap_xuid(xuid)
+                if self.seen.add(xuid):
+                    self._pending.append(xuid)
+            if len(self._pending) >= self.batch_size:
+                batch, self._pending = self._pending, []
+        if batch:
+            self._write(batch)
+
+
+    def observe_match_details(self, details:list[dict]) -> None:
+        '''Record the players of matches flattened by flatten.flatten_match_details, bots are kept apart there.'''
+
+        self.observe([p['id'] for d in details for p in d['players']])
+
+
+    def flush(self) -> None:
+
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if batch:
+            self._write(batch)
+
+
+    def _write(self, xuids:list[str]) -> None:
+
+        self.discovered += self.db.create_frontier_players(xuids)
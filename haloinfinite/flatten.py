@@ -1,4 +1,5 @@
 import json
+from datetime import datetime, timezone
 from dateutil.parser import isoparse
 
 from haloinfinite import util
@@ -40,6 +41,53 @@ def _flatten_match(match:dict) -> dict:
         raise
 
 
+# fields of a flattened match, in the column order of packed matches
+MATCH_FIELDS = (
+    'guid',
+    'started_at',
+    'completed_at',
+    'duration',
+    'map_asset_id',
+    'map_version_id',
+    'map_level_id',
+    'game_variant_asset_id',
+    'game_variant_version_id',
+    'game_variant_category',
+    'playlist_asset_id',
+    'playlist_version_id',
+    'lifecycle_mode_id',
+    'experience_id',
+    'season_id',
+    'playable_duration'
+)
+_MATCH_TIME_FIELDS = ('started_at', 'completed_at')
+
+
+def pack_matches(matches:list[dict]) -> tuple:
+    """Convert flattened matches to columns, a tuple of lists in MATCH_FIELDS order with times as epoch seconds.
+    Much cheaper to pickle between processes than dicts of datetimes."""
+
+    columns = []
+    for f in MATCH_FIELDS:
+        if f in _MATCH_TIME_FIELDS:
+            columns.append([m[f].timestamp() for m in matches])
+        else:
+            # equal values share one object so pickle writes repeated ids (maps, modes, playlists) once
+            shared = {}
+            columns.append([shared.setdefault(m[f], m[f]) for m in matches])
+    return tuple(columns)
+
+
+def unpack_matches(columns:tuple) -> list[dict]:
+    """Convert packed matches back to the flattened form."""
+
+    columns = [
+        [datetime.fromtimestamp(ts, timezone.utc) for ts in col] if f in _MATCH_TIME_FIELDS else col
+        for f, col in zip(MATCH_FIELDS, columns)
+    ]
+    return [dict(zip(MATCH_FIELDS, row)) for row in zip(*columns)]
+
+
 def flatten_game_variant(jdata:dict) -> dict:
 
     name_components = jdata['PublicName'].split(':')
@@ -94,6 +142,19 @@ def _flatten_profile(prof:dict) -> dict:
     return p
 
 
+def flatten_match_details(jdata:dict) -> dict:
+    """Flatten a match stats response into the rows of its teams, players and bots, see Database.create_match_details."""
+
+    players, bots = flatten_match_players(jdata)
+
+    d = {}
+    d['guid'] = jdata['MatchId']
+    d['teams'] = flatten_match_teams(jdata)
+    d['players'] = players
+    d['bots'] = bots
+    return d
+
+
 def flatten_match_teams(jdata:dict) -> list[dict]:
 
     teams = []
@@ -108,13 +169,12 @@ def flatten_match_teams(jdata:dict) -> list[dict]:
 
 def _flatten_match_team(data:dict) -> dict:
 
+    core_stats = data['Stats']['CoreStats']
+
     t = {}
     t['id'] = data['TeamId']
-    t['outcome_id'] = data['Outcome']
-    t['rank'] = data['Rank']
-    t['stats'] = _flatten_stats(data['Stats']['CoreStats'])
-    t['medals'] = _flatten_medals(data['Stats']['CoreStats']['Medals'])
-    _add_mode_stats(t, data['Stats'])
+    t['stats'] = _flatten_stats(core_stats, data['Outcome'], data['Rank'])
+    t['medals'] = _flatten_medals(core_stats['Medals'])
     return t
 
 
@@ -127,8 +187,10 @@ def flatten_match_players(jdata:dict) -> list[dict]:
         flat = _flatten_match_player(p)
         flat['match_guid'] = jdata['MatchId']
         if p['PlayerType'] == 1:
+            flat['id'] = util.unwrap_xuid(flat['id'])
             players.append(flat)
         else:
+            flat['id'] = util.unwrap_bot_id(flat['id'])
             flat['difficulty_id'] = p['BotAttributes']['Difficulty']
             bots.append(flat)
 
@@ -137,138 +199,67 @@ def flatten_match_players(jdata:dict) -> list[dict]:
 
 def _flatten_match_player(data:dict) -> dict:
 
+    # a player has stats for each team they played on, keep the ones of the team they finished on
+    team_stats = data['PlayerTeamStats']
+    core_stats = next((t for t in team_stats if t['TeamId'] == data['LastTeamId']), team_stats[-1])['Stats']['CoreStats']
+    participation = data['ParticipationInfo']
+
     p = {}
     p['id'] = data['PlayerId']
     p['team_id'] = data['LastTeamId']
-    p['outcome_id'] = data['Outcome']
-    p['rank'] = data['Rank']
-    p['joined_at'] = data['FirstJoinedTime']
-    p['left_at'] = data['LastLeaveTime']
-    p['present_at_beginning'] = data['PresentAtBeginning']
-    p['joined_in_progress'] = data['JoinedInProgress']
-    p['left_in_progress'] = data['LeftInProgress']
-    p['present_at_completion'] = data['PresentAtCompletion']
-    p['time_played'] = data['TimePlayed']
+    p['stats'] = _flatten_stats(core_stats, data['Outcome'], data['Rank'])
+    p['stats']['participation_confirmed'] = participation['ConfirmedParticipation']
+    p['stats']['joined_in_progress'] = participation['JoinedInProgress']
+    p['stats']['joined_at'] = isoparse(participation['FirstJoinedTime'])
+    p['stats']['left_at'] = participation['LastLeaveTime'] and isoparse(participation['LastLeaveTime'])
+    p['stats']['present_at_beginning'] = participation['PresentAtBeginning']
+    p['stats']['present_at_completion'] = participation['PresentAtCompletion']
+    p['medals'] = _flatten_medals(core_stats['Medals'])
     return p
 
 
-def _flatten_stats(core_stats:dict) -> dict:
+def _flatten_stats(core_stats:dict, outcome:int, rank:int) -> dict:
 
+    # keys are the columns of the stats table
     s = {}
-    s['score'] = core_stats['Score']
-    s['personal_score'] = core_stats['PersonalScore']
-    s['rounds_won'] = core_stats['RoundsWon']
-    s['rounds_lost'] = core_stats['RoundsLost']
-    s['rounds_tied'] = core_stats['RoundsTied']
     s['kills'] = core_stats['Kills']
     s['deaths'] = core_stats['Deaths']
     s['assists'] = core_stats['Assists']
-    s['suicides'] = core_stats['Suicides']
     s['betrayals'] = core_stats['Betrayals']
+    s['suicides'] = core_stats['Suicides']
+    s['spawns'] = core_stats['Spawns']
+    s['max_killing_spree'] = core_stats['MaxKillingSpree']
+    s['vehicles_destroyed'] = core_stats['VehicleDestroys']
+    s['vehicles_hijacked'] = core_stats['Hijacks']
+    s['medals'] = sum(m['Count'] for m in core_stats['Medals'])
+    s['damage_dealt'] = core_stats['DamageDealt']
+    s['damage_taken'] = core_stats['DamageTaken']
+    s['shots_fired'] = core_stats['ShotsFired']
+    s['shots_landed'] = core_stats['ShotsHit']
+    s['rounds_won'] = core_stats['RoundsWon']
+    s['rounds_lost'] = core_stats['RoundsLost']
+    s['rounds_tied'] = core_stats['RoundsTied']
+    s['melee_kills'] = core_stats['MeleeKills']
     s['grenade_kills'] = core_stats['GrenadeKills']
     s['headshot_kills'] = core_stats['HeadshotKills']
-    s['melee_kills'] = core_stats['MeleeKills']
     s['power_weapon_kills'] = core_stats['PowerWeaponKills']
-    s['shots_fired'] = core_stats['ShotsFired']
-    s['shots_hit'] = core_stats['ShotsHit']
-    s['damage_dealt'] = core_stats['DamageDealt']
-    s['damage_taken'] = core_stats['DamageTaken']
-    s['callout_assists'] = core_stats['CalloutAssists']
-    s['vehicle_destroys'] = core_stats['VehicleDestroys']
-    s['driver_assists'] = core_stats['DriverAssists']
-    s['hijacks'] = core_stats['Hijacks']
     s['emp_assists'] = core_stats['EmpAssists']
-    s['max_killing_spree'] = core_stats['MaxKillingSpree']
+    s['driver_assists'] = core_stats['DriverAssists']
+    s['callout_assists'] = core_stats['CalloutAssists']
+    s['score_personal'] = core_stats['PersonalScore']
+    s['score_points'] = core_stats['Score']
+    s['outcome_id'] = outcome
+    s['rank'] = rank
+    # only players have participation info, see _flatten_match_player
+    s['participation_confirmed'] = None
+    s['joined_in_progress'] = None
+    s['joined_at'] = None
+    s['left_at'] = None
+    s['present_at_beginning'] = None
+    s['present_at_completion'] = None
     return s
 
 
 def _flatten_medals(medals:dict) -> list[dict]:
 
     return [{'id': m['NameId'], 'count': m['Count']} for m in medals]
-
-
-def _add_mode_stats(owner:dict, stats:dict) -> None:
-
-    if len(stats.keys()) > 9:
-        print('More than expected (9) stats keys found for match')
-        with open('too_many_stats_keys.json', 'w') as f:
-            json.dump(stats, f)
-
-    modes = (
-        ('bomb', 'BombStats', _flatten_bomb),
-        ('ctf', 'CaptureTheFlagStats', _flatten_ctf),
-        ('elimination', 'EliminationStats', _flatten_elimination),
-        ('extraction', 'ExtractionStats', _flatten_extraction),
-        ('infection', 'InfectionStats', _flatten_infection),
-        ('oddball', 'OddballStats', _flatten_oddball),
-        ('zones', 'ZonesStats', _flatten_zones),
-        ('stockpile', 'StockpileStats', _flatten_stockpile)
-    )
-    for m in modes:
-        mode_stats = stats.get(m[1])
-        if mode_stats is not None:
-            owner[m[0]] = m[2](mode_stats)
-            # return b/c there can only be one mode stats
-            return
-
-
-def _flatten_bomb(mode_stats:dict):
-
-    print('bomb mode not implemented')
-    with open('bomb.json', 'w') as f:
-        json.dump(mode_stats, f)
-    raise NotImplementedError()
-
-
-def _flatten_ctf(mode_stats:dict):
-
-    raise NotImplementedError()
-
-
-def _flatten_elimination(mode_stats:dict):
-
-    e = {}
-    e['allies_revived'] = mode_stats['AlliesRevived']
-    e['elimination_assists'] = mode_stats['EliminationAssists']
-    e['eliminations'] = mode_stats['Eliminations']
-    e['enemy_revives_denied'] = mode_stats['EnemyRevivesDenied']
-    e['executions'] = mode_stats['Executions']
-    e['kills_as_last_player_standing'] = mode_stats['KillsAsLastPlayerStanding']
-    e['last_players_standing_killed'] = mode_stats['LastPlayersStandingKilled']
-    e['rounds_survived'] = mode_stats['RoundsSurvived']
-    e['times_revived_by_ally'] = mode_stats['TimesRevivedByAlly']
-    e['lives_remaining'] = mode_stats['LivesRemaining']
-    e['elimination_order'] = mode_stats['EliminationOrder']
-    return e
-
-
-def _flatten_extraction(mode_stats:dict):
-
-    print('extraction mode not implemented')
-    with open('extraction.json', 'w') as f:
-        json.dump(mode_stats, f)
-    raise NotImplementedError()
-
-
-def _flatten_infection(mode_stats:dict):
-
-    print('infection mode not implemented')
-    with open('infection.json', 'w') as f:
-        json.dump(mode_stats, f)
-    raise NotImplementedError()
-
-
-def _flatten_oddball(mode_stats:dict):
-
-    pass
-
-
-def _flatten_zones(mode_stats:dict):
-
-    pass
-
-
-def _flatten_stockpile(mode_stats:dict):
-
-    pass
-
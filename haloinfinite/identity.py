@@ -0,0 +1,144 @@
+"""Pool of accounts (identities) that ApiService spreads requests across, to go past one account's request allowance."""
+
+
+import asyncio, threading, time
+
+from haloinfinite import ratelimit
+
+
+class Identity:
+    """One account: its AuthManager (own token file and refresh cycle) and its own rate budget."""
+
+    def __init__(self, name:str, auth_mgr, rate_limiter:ratelimit.RateLimiter=None):
+
+        self.name = name
+        self.auth_mgr = auth_mgr
+        self.rate_limiter = rate_limiter
+        self.in_flight = 0
+        self.sent = 0
+        self.benched_until = 0.0 # monotonic time, set on 401/429
+
+    def __repr__(self):
+
+        return f'Identity({self.name!r})'
+
+
+class IdentityPool:
+    """Schedules requests across identities and takes unhealthy ones out of rotation.
+
+    An identity answered with 429 is benched for the Retry-After time (or THROTTLE_BENCH),
+    one answered with 401 for UNAUTHORIZED_BENCH, long enough for its token to be renewed.
+    Health is tracked per process, each pool worker learns about throttling on its own.
+    """
+
+    STRATEGIES = ('round_robin', 'least_loaded')
+    THROTTLE_BENCH = 30 # seconds, when a 429 comes without Retry-After
+    UNAUTHORIZED_BENCH = 300 # seconds
+
+    def __init__(self, identities:list[Identity], strategy:str='least_loaded'):
+
+        if not identities:
+            raise ValueError('An identity pool needs at least one identity')
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f'Unknown scheduling strategy "{strategy}", expected one of {list(self.STRATEGIES)}')
+
+        self.identities = list(identities)
+        self.strategy = strategy
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_auth_managers(cls, auth_mgrs:list, strategy:str='least_loaded', names:list[str]=None,
+        budgets:dict=None, directory:str=None):
+        """Create a pool with a rate limiter per identity, scoped by the identity's name so the
+        budgets are shared by every process on the host crawling as the same account.
+
+        Args:
+            auth_mgrs (list): An AuthManager (or MockAuthManager) per account.
+            strategy (str): One of STRATEGIES.
+            names (list[str]): Name per identity, defaults to identity0, identity1...
+            budgets (dict): Budget per endpoint family for each identity, see RateLimiter.
+            directory (str): Directory of the rate limiter buckets.
+        """
+
+        names = names or [f'identity{i}' for i in range(len(auth_mgrs))]
+        identities = [
+            Identity(name, auth_mgr, ratelimit.RateLimiter(budgets, directory, scope=name))
+            for name, auth_mgr in zip(names, auth_mgrs)
+        ]
+        return cls(identities, strategy)
+
+    def verify_or_refresh_tokens(self):
+
+        for identity in self.identities:
+            identity.auth_mgr.get_spartan_token()
+
+    def _try_checkout(self):
+        """Take a healthy identity.
+
+        Returns:
+            tuple: (identity, 0) or (None, seconds until the first benched identity is back).
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            healthy = [i for i in self.identities if i.benched_until <= now]
+            if not healthy:
+                return None, min(i.benched_until for i in self.identities) - now
+
+            if self.strategy == 'round_robin':
+                # walk the full list so benched identities keep their place in the rotation
+                while True:
+                    identity = self.identities[self._next % len(self.identities)]
+                    self._next += 1
+                    if identity.benched_until <= now:
+                        break
+            else:
+                identity = min(healthy, key=lambda i: (i.in_flight, i.sent))
+
+            identity.in_flight += 1
+            identity.sent += 1
+            return identity, 0
+
+    def checkout(self) -> Identity:
+        """Block until a healthy identity is available and take it, hand it back with release."""
+
+        while True:
+            identity, wait = self._try_checkout()
+            if identity is not None:
+                return identity
+            time.sleep(wait)
+
+    async def checkout_async(self) -> Identity:
+
+        while True:
+            identity, wait = self._try_checkout()
+            if identity is not None:
+                return identity
+            await asyncio.sleep(wait)
+
+    def release(self, identity:Identity, status:int=None, retry_after:float=None) -> None:
+        """Hand back an identity with the status of its request, benching it on 401/429."""
+
+        with self._lock:
+            identity.in_flight -= 1
+            if status == 429:
+                bench = self.THROTTLE_BENCH if retry_after is None else retry_after
+            elif status == 401:
+                bench = self.UNAUTHORIZED_BENCH
+            else:
+                return
+            identity.benched_until = max(identity.benched_until, time.monotonic() + bench)
+
+        print(f'Benched {identity.name} for {bench:g}s after a {status} response.')
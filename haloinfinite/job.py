@@ -1,12 +1,16 @@
-import math, time, multiprocessing as mp
+import asyncio, math, queue, threading, time, traceback, multiprocessing as mp
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import contextmanager
 from tracemalloc import start
 
-from haloinfinite import api, db, flatten as flat, util
+from haloinfinite import aioapi, api, db, discovery, flatten as flat, util
 
 
 class Job:
 
     MATCH_JOB_TYPE = 'match'
+    DETAILS_JOB_TYPE = 'stats'
     METADATA_JOB_TYPE = 'metadata'
 
     def __init__(self, halo_api:api.ApiService, pgdb:db.Database):
@@ -40,8 +44,133 @@ class Job:
         print('Completed job id', self.id)
 
 
+# state of a pool worker, set up once per process by _init_match_worker (or _init_details_worker) so tasks only carry an offset or guid
+_worker_api = None
+_worker_xuid = None
+# offset of the last page the job needs, shared with the workers so they skip the pages past it
+_stop_offset = None
+
+
+def _init_match_worker(halo_api:api.ApiService, player_xuid:str, stop_offset):
+
+    global _worker_api, _worker_xuid, _stop_offset
+    _worker_api = halo_api
+    _worker_xuid = player_xuid
+    _stop_offset = stop_offset
+
+
+def _get_match_page(start:int) -> tuple:
+    """Fetch and flatten a page of matches in a pool worker.
+
+    Returns:
+        tuple: The offset and the matches packed by flatten.pack_matches, None if the page was skipped.
+    """
+
+    # the job found where to stop after this page was queued
+    if start > _stop_offset.value:
+        return start, None
+
+    jdata = _worker_api.get_player_matches(_worker_xuid, start)
+    return start, flat.pack_matches(flat.flatten_matches(jdata))
+
+
+class MatchWriter:
+    """Writer stage of the MatchJob pipeline, a thread that merges pages of matches into large inserts.
+
+    put blocks while `max_pages` pages are waiting, so fetching can't get ahead of the database
+    and memory stays bounded however long the history is. Pages are lists of flattened matches,
+    or columns from flatten.pack_matches.
+    """
+
+    def __init__(self, pgdb:db.Database, job_id:int, batch_size:int=500, max_pages:int=64):
+
+        self.db = pgdb
+        self.job_id = job_id
+        self.batch_size = batch_size
+        self.matches_inserted = 0
+        self.error = None
+        self._pages = queue.Queue(max_pages)
+        self._thread = threading.Thread(target=self._run, name='match-writer', daemon=True)
+
+
+    def __enter__(self):
+
+        self._thread.start()
+        return self
+
+
+    def __exit__(self, exc_type, *exc_info):
+
+        self.close()
+
+
+    def put(self, matches:list[dict]) -> None:
+
+        if self.error is not None:
+            raise self.error
+        self._pages.put(matches)
+
+
+    def close(self) -> None:
+        """Write what is queued and stop the thread, raising the error that stopped it, if any."""
+
+        self._pages.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+    def _run(self):
+
+        done = False
+        while not done:
+            # block for one page, then take whatever else is already waiting up to the batch size
+            batch = {}
+            page = self._pages.get()
+            while page is not None:
+                self._add(batch, page)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    page = self._pages.get_nowait()
+                except queue.Empty:
+                    break
+            done = page is None
+
+            if batch and self.error is None:
+                try:
+                    self.matches_inserted += self._write(list(batch.values()))
+                except Exception as e:
+                    # keep draining so producers blocked on put are released, put re-raises this
+                    self.error = e
+
+
+    def _add(self, batch:dict, page) -> None:
+
+        if isinstance(page, tuple):
+            page = flat.unpack_matches(page)
+        # pages can overlap when new matches are played mid-job, keep each guid once
+        batch.update((m['guid'], m) for m in page)
+
+
+    def _write(self, matches:list[dict]) -> int:
+
+        return len(self.db.create_job_matches_from(self.job_id, matches))
+
+
 class MatchJob(Job):
-    def __init__(self, player_id:int, halo_api:api.ApiService, pgdb:db.Database=db.Database(db.PROD_DB)):
+
+    # pages requested at a time past the probed end of the history, which can grow while the job runs
+    SPECULATIVE_PAGES = 1
+    # no page can be past this offset before the end of the history has been seen
+    NO_STOP_OFFSET = 2 ** 62
+    # default for the matches merged into one COPY and merge by the writer
+    WRITE_BATCH_SIZE = 1000
+    # pages waiting for the writer before fetching is held back
+    WRITE_QUEUE_PAGES = 64
+
+    def __init__(self, player_id:int, halo_api:api.ApiService, pgdb:db.Database=db.Database(db.PROD_DB), total_matches:int=None,
+        write_batch_size:int=None):
 
         super().__init__(halo_api, pgdb)
 
@@ -57,6 +186,9 @@ class MatchJob(Job):
         self.player_gamertag = None
         self.history_match_count = None
         self.history_last_match_at = None
+        # MatchesPlayedCount, when the caller already probed it
+        self.total_matches = total_matches
+        self.write_batch_size = write_batch_size or self.WRITE_BATCH_SIZE
         self._load_history()
 
 
@@ -80,6 +212,9 @@ class MatchJob(Job):
         """This will not include matches that were left, but those matches WILL be returned when getting match data?
         So this count is lower than what will actually be returned."""
 
+        if self.total_matches is not None:
+            return self.total_matches
+
         jdata = self.halo_api.get_player_match_count(self.player_xuid)
         # this is combined matchmade, custom, and local games, individual counts are also available
         return jdata['MatchesPlayedCount']
@@ -87,7 +222,8 @@ class MatchJob(Job):
 
     def _get_expected_matches(self):
 
-        print('Getting total matches played from the API')
+        if self.total_matches is None:
+            print('Getting total matches played from the API')
 
         # get the total number of matches played by the player
         total_matches = self._get_total_player_match_count()
@@ -101,10 +237,64 @@ class MatchJob(Job):
         return expected_matches
 
 
-    def _get_match_batch(self, start:int):
+    def _is_past_end(self, offset:int) -> bool:
+        """Whether the match at the offset is past the end of the history, or one that was already retrieved."""
 
-        jdata = self.halo_api.get_player_matches(self.player_xuid, start)
-        return flat.flatten_matches(jdata)
+        matches = flat.flatten_matches(self.halo_api.get_player_matches(self.player_xuid, offset, 1))
+        return not matches or (self.history_last_match_at is not None and matches[0]['started_at'] <= self.history_last_match_at)
+
+
+    def _find_history_end(self, hint:int) -> int:
+        """Find the offset where the matches left to retrieve end, to within a page, with single match requests.
+
+        The match count hint is probed first, then the search widens exponentially until it
+        passes the end and narrows by bisection. A job with a good hint needs two probes.
+
+        Args:
+            hint (int): Expected number of matches to retrieve.
+
+        Returns:
+            int: An offset at or past the end, no more than a page after it.
+        """
+
+        batch_size = self.halo_api.PLAYER_MATCHES_BATCH_SIZE
+        needed = -1 # highest offset known to hold a match to retrieve
+        past_end = None # lowest offset known to be past the end
+        probe = max(hint, 0)
+        while past_end is None:
+            if self._is_past_end(probe):
+                past_end = probe
+            else:
+                needed = probe
+                probe = max(2 * probe, batch_size)
+
+        # an accurate hint lands just past the end, check a page below it before bisecting
+        if past_end - needed > batch_size and past_end > batch_size:
+            probe = past_end - batch_size
+            if self._is_past_end(probe):
+                past_end = probe
+            else:
+                needed = probe
+
+        while past_end - needed > batch_size:
+            probe = (needed + past_end) // 2
+            if self._is_past_end(probe):
+                past_end = probe
+            else:
+                needed = probe
+
+        return past_end
+
+
+    def _plan_pages(self) -> int:
+        """Get the offset the page requests fan out to, see _find_history_end."""
+
+        expected_matches = self._get_expected_matches()
+        end = self._find_history_end(expected_matches)
+        batch_size = self.halo_api.PLAYER_MATCHES_BATCH_SIZE
+
+        print(f'Found about {end} new matches, requesting {math.ceil(end / batch_size)} pages.')
+        return math.ceil(end / batch_size) * batch_size
 
 
     def _is_complete(self, match_batch:list[dict]):
@@ -114,62 +304,199 @@ class MatchJob(Job):
             (self.history_last_match_at and match_batch[-1]['started_at'] < self.history_last_match_at))
 
 
-    def _create_matches(self, matches:list[dict]) -> None:
+    def _is_packed_complete(self, columns:tuple) -> bool:
+        """_is_complete for a page packed by flatten.pack_matches."""
+
+        started_at = columns[flat.MATCH_FIELDS.index('started_at')]
+        return (len(started_at) < self.halo_api.PLAYER_MATCHES_BATCH_SIZE or
+            (self.history_last_match_at and started_at[-1] < self.history_last_match_at.timestamp()))
+
+
+    def _page_window(self, offset:int, expected_offset:int, max_in_flight:int) -> int:
+        """Get how many page requests may be in flight before queueing the page at the offset,
+        only speculating a few pages past the probed end."""
+
+        return max_in_flight if offset < expected_offset else min(max_in_flight, self.SPECULATIVE_PAGES)
+
+
+    def _make_writer(self) -> MatchWriter:
+
+        # a batch can't outgrow what the queue holds, let it hold at least one batch
+        max_pages = max(self.WRITE_QUEUE_PAGES, math.ceil(self.write_batch_size / self.halo_api.PLAYER_MATCHES_BATCH_SIZE))
+        return MatchWriter(self.db, self.id, self.write_batch_size, max_pages)
 
-        new_match_ids = self.db.create_matches(matches)
-        self.db.create_job_matches(self.id, new_match_ids)
-        self.matches_inserted += len(new_match_ids)
 
+    def _print_progress(self, writer:MatchWriter):
 
-    def run(self):
+        print(f'{self.matches_retrieved} matches retrieved, {writer.matches_inserted} matches inserted...', end='\r')
+
+
+    def run(self, max_in_flight:int=None):
+        """Run the job as a pipeline: pool workers fetch and flatten pages, the main thread hands
+        finished pages to a writer thread that inserts them in large batches.
+
+        Args:
+            max_in_flight (int): Max pages queued on the pool at once, defaults to twice the cpu count.
+        """
 
         # start timing
         started_at = time.time()
 
-        # create the job
-        self.create()
+        # create the job and attach the player to it in one transaction
+        with self.db.transaction():
+            self.create()
+            self.db.create_job_player(self.id, self.player_id)
 
-        # attach the player to the job
-        self.db.create_job_player(self.id, self.player_id)
+        # warm the dimension cache so the writer resolves most matches without queries
+        self.db.load_dimensions()
 
-        # get the number of matches expected for the player
-        expected_matches = self._get_expected_matches()
+        # find how many pages are needed
+        expected_offset = self._plan_pages()
 
         cpu_count = util.get_available_cpu_count()
-        
-        # start a multiprocessing pool and distribute data loading processes
+        max_in_flight = max_in_flight or 2 * cpu_count
+        batch_size = self.halo_api.PLAYER_MATCHES_BATCH_SIZE
+
         offset = 0
-        complete = False
-        with mp.Pool(cpu_count) as pool:
-            while not complete:
-                results = []
-                # use the service record to determine the initial number of batches, then use
-                # the number of available processors to grab additional matches if the service record
-                # match count is inaccurate
-                num_batches = math.ceil(expected_matches / self.halo_api.PLAYER_MATCHES_BATCH_SIZE) if offset == 0 else cpu_count
-                for _ in range(num_batches):
-                    # queue a match request and increment the offset
-                    results.append(pool.apply_async(self._get_match_batch, (offset,)))
-                    offset += self.halo_api.PLAYER_MATCHES_BATCH_SIZE
-
-                # process results as they are available
-                for r in results:
-                    matches = r.get()
-                    self.matches_retrieved += len(matches)
-                    self._create_matches(matches)
-                    print(f'{self.matches_retrieved} matches retrieved, {self.matches_inserted} matches inserted...', end='\r')
-                    if self._is_complete(matches):
-                        # set the completion flag here so the remaining workers can finish
-                        complete = True
+        in_flight = 0
+        complete = expected_offset == 0
+        stop_offset = mp.RawValue('q', self.NO_STOP_OFFSET)
+        # finished batches (or worker errors) are put here as they complete, in any order,
+        # so one slow page doesn't hold up inserting the pages behind it
+        finished = queue.Queue()
+        worker_args = (self.halo_api, self.player_xuid, stop_offset)
+        with mp.Pool(cpu_count, _init_match_worker, worker_args) as pool, self._make_writer() as writer:
+            while in_flight or not complete:
+                # top up the pages in flight
+                while not complete and in_flight < self._page_window(offset, expected_offset, max_in_flight):
+                    pool.apply_async(_get_match_page, (offset,), callback=finished.put, error_callback=finished.put)
+                    offset += batch_size
+                    in_flight += 1
+
+                result = finished.get()
+                in_flight -= 1
+                if isinstance(result, Exception):
+                    raise result
+                start, columns = result
+                if columns is None or start > stop_offset.value:
+                    # a page past the end, skipped by the worker or finished before the end was seen
+                    continue
+
+                self.matches_retrieved += len(columns[0])
+                # blocks while the writer is behind, which holds back new requests
+                # the writer unpacks the page, keeping this thread free to collect results
+                writer.put(columns)
+                self._print_progress(writer)
+                if self._is_packed_complete(columns):
+                    # stop queueing pages, workers skip the queued pages past this one
+                    complete = True
+                    stop_offset.value = min(stop_offset.value, start)
+
+        self.matches_inserted = writer.matches_inserted
+        self._finish(started_at)
+
+
+    def _finish(self, started_at:float):
 
         self.duration = time.time() - started_at
 
         print(f'Retrieved {self.matches_retrieved} matches in {self.duration:.1f} seconds ({(self.matches_retrieved / self.duration):.1f} matches/second)')
-        print(f'Inserted {self.matches_inserted} matches into the database ({(100 * self.matches_inserted / self.matches_retrieved):.1f}% of retrieved)')
+        print(f'Inserted {self.matches_inserted} matches into the database ({(100 * self.matches_inserted / max(1, self.matches_retrieved)):.1f}% of retrieved)')
 
         self.complete()
 
 
+    def run_async(self, max_in_flight:int=64, flatten_executor:Executor=None, service_loop:aioapi.ServiceLoop=None):
+        """Run the job on a single event loop, keeping up to `max_in_flight` page requests open at once.
+
+        Args:
+            max_in_flight (int): Max concurrent page requests, independent of the cpu count.
+            flatten_executor (Executor): Flattening runs on the loop by default since a page is cheap
+                to flatten compared to fetching it. Pass an executor (e.g. a ProcessPoolExecutor)
+                if the loop becomes CPU bound at high concurrency.
+            service_loop (ServiceLoop): Fetch pages with the AsyncApiService of a running loop shared
+                with other jobs. By default the job runs its own loop and service.
+        """
+
+        started_at = time.time()
+
+        with self.db.transaction():
+            self.create()
+            self.db.create_job_player(self.id, self.player_id)
+        self.db.load_dimensions()
+        expected_offset = self._plan_pages()
+
+        if service_loop is None:
+            self.matches_inserted = asyncio.run(self._run_pages_own_service(expected_offset, max_in_flight, flatten_executor))
+        else:
+            self.matches_inserted = service_loop.run(
+                self._run_pages_async(service_loop.api, expected_offset, max_in_flight, flatten_executor))
+
+        self._finish(started_at)
+
+
+    async def _get_match_batch_async(self, halo_api:aioapi.AsyncApiService, start:int, flatten_executor:Executor):
+
+        jdata = await halo_api.get_player_matches(self.player_xuid, start)
+        if flatten_executor is None:
+            return start, flat.flatten_matches(jdata)
+        return start, await asyncio.get_running_loop().run_in_executor(flatten_executor, flat.flatten_matches, jdata)
+
+
+    async def _run_pages_own_service(self, expected_offset:int, max_in_flight:int, flatten_executor:Executor):
+
+        async with aioapi.AsyncApiService.from_service(self.halo_api, max_in_flight) as halo_api:
+            return await self._run_pages_async(halo_api, expected_offset, max_in_flight, flatten_executor)
+
+
+    async def _run_pages_async(self, halo_api:aioapi.AsyncApiService, expected_offset:int, max_in_flight:int,
+        flatten_executor:Executor):
+
+        loop = asyncio.get_running_loop()
+        batch_size = self.halo_api.PLAYER_MATCHES_BATCH_SIZE
+        offset = 0
+        complete = expected_offset == 0
+        stop_offset = self.NO_STOP_OFFSET
+        pending = {}
+
+        # the writer thread keeps inserts off the event loop, handing it pages from a helper
+        # thread leaves the loop free while put blocks on a full queue
+        with self._make_writer() as writer, ThreadPoolExecutor(1) as handoff:
+            try:
+                while pending or not complete:
+                    # top up the requests in flight
+                    while not complete and len(pending) < self._page_window(offset, expected_offset, max_in_flight):
+                        task = asyncio.create_task(self._get_match_batch_async(halo_api, offset, flatten_executor))
+                        pending[task] = offset
+                        offset += batch_size
+
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        del pending[task]
+                        if task.cancelled():
+                            continue
+                        start, matches = task.result()
+                        if start > stop_offset:
+                            continue
+
+                        self.matches_retrieved += len(matches)
+                        await loop.run_in_executor(handoff, writer.put, matches)
+                        self._print_progress(writer)
+                        if self._is_complete(matches):
+                            # stop queueing pages and cancel the requests for pages past this one
+                            complete = True
+                            stop_offset = min(stop_offset, start)
+                            for other, other_start in pending.items():
+                                if other_start > stop_offset:
+                                    other.cancel()
+            finally:
+                # a failed job on a shared loop would otherwise leave its requests running
+                for task in pending:
+                    task.cancel()
+
+        return writer.matches_inserted
+
+
 class MetadataJob(Job):
     def __init__(self, halo_api:api.ApiService, pgdb:db.Database=db.Database(db.PROD_DB)):
 
@@ -351,10 +678,307 @@ class MetadataJob(Job):
         self.complete()
 
 
-class MatchDetailsJob:
-    def __init__(self, pgdb:db.Database):
+def _init_details_worker(halo_api:api.ApiService):
 
-        self.db = pgdb
+    global _worker_api
+    _worker_api = halo_api
+
+
+def _get_match_details(match_guid:str) -> tuple:
+    """Fetch and flatten a match's stats in a pool worker.
+
+    Returns:
+        tuple: The guid and the details from flatten.flatten_match_details, None if they couldn't be loaded.
+    """
+
+    try:
+        return match_guid, flat.flatten_match_details(_worker_api.get_match_stats(match_guid))
+    except Exception:
+        # one bad match shouldn't stop the job, it's retried once its lease expires
+        print(f'Failed to load the details of match {match_guid}:')
+        traceback.print_exc()
+        return match_guid, None
+
+
+class MatchDetailsWriter(MatchWriter):
+    """Writer stage of the MatchDetailsJob pipeline, pages are the details of one match.
+    The players of the loaded matches are passed on to `player_discovery`, if set."""
+
+    def __init__(self, pgdb:db.Database, job_id:int, batch_size:int=500, max_pages:int=64,
+        player_discovery:discovery.Discovery=None):
+
+        super().__init__(pgdb, job_id, batch_size, max_pages)
+        self.player_discovery = player_discovery
+
+
+    def _add(self, batch:dict, details:dict) -> None:
+
+        batch[details['guid']] = details
+
+
+    def _write(self, details:list[dict]) -> int:
+
+        # before loading, which creates the players, though only as participants outside the crawl queue
+        if self.player_discovery is not None:
+            self.player_discovery.observe_match_details(details)
+        return self.db.create_match_details(details)
+
+
+class MatchDetailsJob(Job):
+    """Loads the stats of matches that don't have them yet, e.g. matches inserted by MatchJobs.
+
+    Matches are leased in batches, see Database.lease_matches_without_details, so several jobs
+    on any number of hosts can run at once. A thread renews the leases until the matches are
+    loaded, and the leases of matches that failed are released for other workers to retry. The stats are fetched by pool workers (run) or on an
+    event loop (run_async), and a writer thread loads them for many matches at a time, with one
+    statement per table. The players found in them are added to the crawl frontier, see
+    discovery.Discovery.
+    """
+
+    # matches leased at once, their leases must outlast fetching and loading them
+    LEASE_BATCH_SIZE = 500
+    LEASE_SECONDS = 900
+    # matches merged into one load by the writer, each has about 16 stats rows and dozens of medal rows
+    WRITE_BATCH_SIZE = 100
+    # matches waiting for the writer before fetching is held back
+    WRITE_QUEUE_PAGES = 1000
+
+    def __init__(self, halo_api:api.ApiService, pgdb:db.Database=db.Database(db.PROD_DB), max_matches:int=None,
+        discover_players:bool=True):
+        """
+        Args:
+            halo_api (ApiService): Client passed to the pool workers.
+            pgdb (Database): Database the matches are read from and the stats written to.
+            max_matches (int): Stop after this many matches, by default the job runs until no match is left.
+            discover_players (bool): Add the players of the loaded matches to the crawl frontier.
+        """
+
+        super().__init__(halo_api, pgdb)
+
+        self.job_type = self.DETAILS_JOB_TYPE
+        self.max_matches = max_matches
+        self.worker_id = util.worker_id()
+        self.player_discovery = discovery.Discovery(pgdb) if discover_players else None
+
+        self.matches_leased = 0
+        self.matches_retrieved = 0
+        self.matches_failed = 0
+        self.matches_inserted = 0
+        self._leased = {} # guid: id of the matches leased and not yet loaded
+        self._failed_ids = [] # not leased again by this job
+        self._lock = threading.Lock()
+
+
+    def _lease_matches(self) -> list[str]:
+
+        limit = self.LEASE_BATCH_SIZE
+        if self.max_matches is not None:
+            limit = min(limit, self.max_matches - self.matches_leased)
+        if limit <= 0:
+            return []
+
+        matches = self.db.lease_matches_without_details(self.worker_id, self.LEASE_SECONDS, limit, self._failed_ids)
+        self.matches_leased += len(matches)
+        with self._lock:
+            self._leased.update((m.guid, m.id) for m in matches)
+        return [m.guid for m in matches]
+
+
+    def _release_failed(self, guid:str) -> None:
+        '''Give up the lease of a match that couldn't be loaded, so another worker can retry it now.'''
+
+        self.matches_failed += 1
+        with self._lock:
+            match_id = self._leased.pop(guid, None)
+        if match_id is None:
+            return
+        self._failed_ids.append(match_id)
+        try:
+            self.db.release_leases(db.MATCH_DETAILS_LEASE, [match_id], self.worker_id)
+        except Exception:
+            # the lease expires instead
+            traceback.print_exc()
+
+
+    def _renew_leases(self, stopped:threading.Event) -> None:
+        '''Keep the leases of the matches not loaded yet, a few times per lease period, until stopped.'''
+
+        while not stopped.wait(self.LEASE_SECONDS / 3):
+            with self._lock:
+                match_ids = list(self._leased.values())
+            try:
+                renewed = self.db.renew_leases(db.MATCH_DETAILS_LEASE, match_ids, self.worker_id, self.LEASE_SECONDS)
+            except Exception:
+                # the leases are still good for a while, try again next period
+                traceback.print_exc()
+                continue
+            # loading a match deletes its lease, so the matches that weren't renewed are done
+            # (or, rarely, their lease expired and was taken over) and aren't renewed again
+            gone = set(match_ids) - set(renewed)
+            if gone:
+                with self._lock:
+                    self._leased = {guid: id for guid, id in self._leased.items() if id not in gone}
+
+
+    @contextmanager
+    def _renewing_leases(self):
+
+        stopped = threading.Event()
+        renewer = threading.Thread(target=self._renew_leases, args=(stopped,), name='details-leases', daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            renewer.join()
+
+
+    def _make_writer(self) -> MatchDetailsWriter:
+
+        return MatchDetailsWriter(self.db, self.id, self.WRITE_BATCH_SIZE, self.WRITE_QUEUE_PAGES, self.player_discovery)
+
+
+    def _start(self):
+
+        self.create()
+        if self.player_discovery is not None:
+            self.player_discovery.load_known()
+
+
+    def _print_progress(self, writer:MatchDetailsWriter):
+
+        print(f'{self.matches_retrieved} matches retrieved, {writer.matches_inserted} matches loaded...', end='\r')
+
+
+    def run(self, max_in_flight:int=None):
+        """Run the job as a pipeline: pool workers fetch and flatten match stats, the main thread
+        hands them to a writer thread that loads them in large batches.
+
+        Args:
+            max_in_flight (int): Max matches queued on the pool at once, defaults to twice the cpu count.
+        """
+
+        started_at = time.time()
+
+        self._start()
+
+        cpu_count = util.get_available_cpu_count()
+        max_in_flight = max_in_flight or 2 * cpu_count
+
+        guids = deque()
+        in_flight = 0
+        exhausted = False
+        finished = queue.Queue()
+        # the renewer outlives the writer, which is still loading leased matches when the pool is done
+        with self._renewing_leases(), mp.Pool(cpu_count, _init_details_worker, (self.halo_api,)) as pool, self._make_writer() as writer:
+            while True:
+                # top up the matches in flight, leasing more when the leased ones are all queued
+                while in_flight < max_in_flight:
+                    if not guids and not exhausted:
+                        guids.extend(self._lease_matches())
+                        exhausted = not guids
+                    if not guids:
+                        break
+                    pool.apply_async(_get_match_details, (guids.popleft(),), callback=finished.put, error_callback=finished.put)
+                    in_flight += 1
+
+                if not in_flight:
+                    break
+
+                result = finished.get()
+                in_flight -= 1
+                if isinstance(result, Exception):
+                    raise result
+                guid, details = result
+                if details is None:
+                    self._release_failed(guid)
+                    continue
+
+                self.matches_retrieved += 1
+                # blocks while the writer is behind, which holds back new requests
+                writer.put(details)
+                self._print_progress(writer)
+
+        self.matches_inserted = writer.matches_inserted
+        self._finish(started_at)
+
+
+    def _finish(self, started_at:float):
+
+        self.duration = time.time() - started_at
+
+        print(f'Retrieved the stats of {self.matches_retrieved} matches in {self.duration:.1f} seconds ({(self.matches_retrieved / self.duration):.1f} matches/second), {self.matches_failed} failed')
+        print(f'Loaded the stats of {self.matches_inserted} matches into the database')
+
+        if self.player_discovery is not None:
+            self.player_discovery.flush()
+            print(f'Added {self.player_discovery.discovered} new players to the crawl frontier')
+
+        self.complete()
+
+
+    def run_async(self, max_in_flight:int=64, flatten_executor:Executor=None):
+        """Run the job on a single event loop, keeping up to `max_in_flight` stats requests open at once.
+
+        Args:
+            max_in_flight (int): Max concurrent stats requests, independent of the cpu count.
+            flatten_executor (Executor): Executor to flatten in, e.g. a ProcessPoolExecutor, on the loop by default.
+        """
+
+        started_at = time.time()
+
+        self._start()
+
+        self.matches_inserted = asyncio.run(self._run_async(max_in_flight, flatten_executor))
+
+        self._finish(started_at)
+
+
+    async def _get_match_details_async(self, halo_api:aioapi.AsyncApiService, match_guid:str, flatten_executor:Executor) -> tuple:
+        """Like _get_match_details, on the loop."""
+
+        try:
+            jdata = await halo_api.get_match_stats(match_guid)
+            if flatten_executor is None:
+                return match_guid, flat.flatten_match_details(jdata)
+            return match_guid, await asyncio.get_running_loop().run_in_executor(flatten_executor, flat.flatten_match_details, jdata)
+        except Exception:
+            print(f'Failed to load the details of match {match_guid}:')
+            traceback.print_exc()
+            return match_guid, None
+
+
+    async def _run_async(self, max_in_flight:int, flatten_executor:Executor) -> int:
+
+        loop = asyncio.get_running_loop()
+        guids = deque()
+        exhausted = False
+        pending = set()
+
+        # leasing and handing matches to the writer block, keep them off the loop
+        with self._renewing_leases(), self._make_writer() as writer, ThreadPoolExecutor(1) as handoff:
+            async with aioapi.AsyncApiService.from_service(self.halo_api, max_in_flight) as halo_api:
+                while True:
+                    while len(pending) < max_in_flight:
+                        if not guids and not exhausted:
+                            guids.extend(await loop.run_in_executor(handoff, self._lease_matches))
+                            exhausted = not guids
+                        if not guids:
+                            break
+                        pending.add(asyncio.create_task(self._get_match_details_async(halo_api, guids.popleft(), flatten_executor)))
+
+                    if not pending:
+                        break
+
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        guid, details = task.result()
+                        if details is None:
+                            await loop.run_in_executor(handoff, self._release_failed, guid)
+                            continue
 
-        # self.id = pgdb.insert_match_details_job()
+                        self.matches_retrieved += 1
+                        await loop.run_in_executor(handoff, writer.put, details)
+                        self._print_progress(writer)
 
+        return writer.matches_inserted
@@ -0,0 +1,320 @@
+"""Local stand-in for the Halo Infinite endpoints called by ApiService, for load testing the crawler.
+
+Serves the fixtures in tests/data, synthesizes paginated match histories of any length and can
+inject latency, throttling (429) and server errors (503). Point an ApiService at it with
+`ApiService(MockAuthManager(), base_urls=server.base_urls)`.
+"""
+
+
+import copy, json, math, os, random, re, sys, threading, time, uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from haloinfinite import util
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'data')
+MATCH_STATS_FILES = [
+    '21416434-4717-4966-9902-af7097469f74.json',
+    '6ff6af98-5696-413a-a315-afc74e36fdbe.json',
+    '8d641322-8553-44f0-b991-89d028377c62.json'
+]
+
+# synthesized histories start here and have one match every MATCH_INTERVAL
+HISTORY_EPOCH = datetime(2022, 1, 1, tzinfo=timezone.utc)
+MATCH_INTERVAL = timedelta(minutes=10)
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+
+    def handle_error(self, request, client_address):
+
+        # clients dropping keep-alive connections, e.g. cancelled requests, aren't errors here
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+
+class MockAuthManager:
+    '''Stands in for AuthManager, the mock server accepts any token.'''
+
+    def __init__(self, name:str='mock'):
+
+        self.spartan_token = f'{name}-spartan-token'
+        self.user_hash = name
+
+
+    def get_spartan_token(self):
+
+        return self.spartan_token
+
+
+    def get_current_spartan_token(self):
+
+        return self.spartan_token
+
+
+    def get_xbox_live_v3_token(self):
+
+        return f'XBL3.0 x={self.user_hash};{self.spartan_token}'
+
+
+class MockHaloServer:
+    '''Threaded HTTP server mimicking the halostats, skill, discovery and profile endpoints.
+
+    Each endpoint family is served under its own path prefix, see base_urls.
+    '''
+
+    def __init__(self, host:str='127.0.0.1', port:int=0, data_dir:str=DEFAULT_DATA_DIR, history_length:int=1000,
+        latency_median:float=0.05, latency_sigma:float=0.5, throttle_rate:float=0.0, error_rate:float=0.0,
+        retry_after:float=1.0, seed:int=None):
+        """
+        Args:
+            host (str): Interface to listen on.
+            port (int): Port to listen on, 0 picks a free port.
+            data_dir (str): Directory with the fixture files.
+            history_length (int): Matches in each player's history, override per player with set_history_length.
+            latency_median (float): Median response latency in seconds, latencies are log-normally distributed.
+            latency_sigma (float): Shape of the latency distribution, higher values give a longer tail.
+            throttle_rate (float): Fraction of requests answered with 429 and a Retry-After header.
+            error_rate (float): Fraction of requests answered with 503.
+            retry_after (float): Seconds sent in Retry-After.
+            seed (int): Seed for the latency and failure randomness.
+        """
+
+        self.history_length = history_length
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+
+        self.histories = {}
+        self.statuses = Counter()
+        # requests per auth token and tokens answered with 401, to exercise identity pools
+        self.requests_by_token = Counter()
+        self.unauthorized_tokens = set()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._load_fixtures(data_dir)
+
+        self._httpd = _QuietHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+
+    def __enter__(self):
+
+        return self.start()
+
+
+    def __exit__(self, *exc_info):
+
+        self.stop()
+
+
+    def _load_fixtures(self, data_dir:str):
+
+        def load(file_name):
+            with open(os.path.join(data_dir, file_name)) as f:
+                return json.load(f)
+
+        self.match_templates = load('player_matches.json')['Results']
+        self.match_count = load('player_match_count.json')
+        self.match_stats = [load(f) for f in MATCH_STATS_FILES]
+        self.privacy = load('player_privacy.json')
+        self.skill = load('player_match_skill.json')
+        self.assets = {
+            'maps': load('map.json'),
+            'playlists': load('playlist_quickplay.json'),
+            'ugcGameVariants': load('gamevariant.json'),
+            'mapModePairs': load('map_mode_pair.json')
+        }
+
+
+    @property
+    def base_urls(self) -> dict:
+
+        host, port = self._httpd.server_address[:2]
+        root = f'http://{host}:{port}'
+        return {family: f'{root}/{family}' for family in ('halostats', 'skill', 'discovery', 'profile')}
+
+
+    def start(self):
+
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+
+    def stop(self):
+
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+    def serve_forever(self):
+
+        self._httpd.serve_forever()
+
+
+    def set_history_length(self, xuid:str, length:int):
+
+        self.histories[util.unwrap_xuid(xuid)] = length
+
+
+    def get_history_length(self, xuid:str) -> int:
+
+        return self.histories.get(util.unwrap_xuid(xuid), self.history_length)
+
+
+    def _inject(self):
+        """Sleep for a sampled latency and pick an injected failure status, if any."""
+
+        with self._lock:
+            latency = self._random.lognormvariate(math.log(self.latency_median), self.latency_sigma) if self.latency_median > 0 else 0
+            roll = self._random.random()
+        time.sleep(latency)
+
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 503
+        return None
+
+
+    def _record(self, status:int):
+
+        with self._lock:
+            self.statuses[status] += 1
+
+
+    def get_player_matches(self, xuid:str, start:int, count:int) -> dict:
+
+        # number matches from the oldest so ids and times stay stable when a history grows
+        length = self.get_history_length(xuid)
+        results = []
+        for i in range(start, min(start + count, length)):
+            number = length - i
+            template = self.match_templates[number % len(self.match_templates)]
+            match = copy.deepcopy(template)
+            started_at = HISTORY_EPOCH + number * MATCH_INTERVAL
+            duration = util.parse_iso_duration(template['MatchInfo']['Duration'])
+            match['MatchId'] = str(uuid.uuid5(uuid.NAMESPACE_URL, f'{util.unwrap_xuid(xuid)}/{number}'))
+            match['MatchInfo']['StartTime'] = started_at.isoformat().replace('+00:00', 'Z')
+            match['MatchInfo']['EndTime'] = (started_at + timedelta(seconds=duration)).isoformat().replace('+00:00', 'Z')
+            results.append(match)
+
+        return {'Start': start, 'Count': count, 'ResultCount': len(results), 'Results': results, 'Links': {}}
+
+
+    def get_player_match_count(self, xuid:str) -> dict:
+
+        jdata = dict(self.match_count)
+        jdata['MatchesPlayedCount'] = self.get_history_length(xuid)
+        return jdata
+
+
+    def get_match_stats(self, match_guid:str) -> dict:
+
+        jdata = copy.deepcopy(self.match_stats[uuid.UUID(match_guid).int % len(self.match_stats)])
+        jdata['MatchId'] = match_guid
+        return jdata
+
+
+    def get_asset(self, kind:str, asset_id:str, version_id:str) -> dict:
+
+        jdata = copy.deepcopy(self.assets[kind])
+        jdata['AssetId'] = asset_id
+        jdata['VersionId'] = version_id
+        return jdata
+
+
+    def get_profiles(self, user_ids:list[str]) -> dict:
+
+        return {'profileUsers': [{
+            'id': uid,
+            'hostId': uid,
+            'settings': [{'id': 'Gamertag', 'value': f'Mock {uid[-8:]}'}],
+            'isSponsoredUser': False
+        } for uid in user_ids]}
+
+
+    def route(self, method:str, path:str, query:dict, body:dict) -> dict:
+        """Get the response for a request, or None if nothing is served at the path."""
+
+        routes = (
+            ('GET', r'/halostats/hi/players/([^/]+)/matches', lambda m: self.get_player_matches(
+                m[1], int(query.get('start', ['0'])[0]), int(query.get('count', ['25'])[0]))),
+            ('GET', r'/halostats/hi/players/([^/]+)/matches/count', lambda m: self.get_player_match_count(m[1])),
+            ('GET', r'/halostats/hi/players/([^/]+)/matches-privacy', lambda m: self.privacy),
+            ('GET', r'/halostats/hi/matches/([^/]+)/stats', lambda m: self.get_match_stats(m[1])),
+            ('GET', r'/skill/hi/matches/([^/]+)/skill', lambda m: self.skill),
+            ('GET', r'/discovery/hi/(maps|playlists|ugcGameVariants|mapModePairs)/([^/]+)/versions/([^/]+)', lambda m: self.get_asset(m[1], m[2], m[3])),
+            ('POST', r'/profile/users/batch/profile/settings', lambda m: self.get_profiles(body['userIds']))
+        )
+        for route_method, pattern, handler in routes:
+            m = re.fullmatch(pattern, path)
+            if route_method == method and m is not None:
+                return handler(m)
+        return None
+
+
+    def _make_handler(self):
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1' # keep-alive
+
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self, status:int, jdata:dict=None, headers:dict=None):
+
+                body = b'' if jdata is None else json.dumps(jdata).encode()
+                try:
+                    self.send_response(status)
+                    for key, value in (headers or {}).items():
+                        self.send_header(key, value)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up on the request, e.g. the losing side of a hedged request
+                    self.close_connection = True
+                    return
+                server._record(status)
+
+            def _handle(self, method:str):
+
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+
+                token = self.headers.get('x-343-authorization-spartan') or self.headers.get('Authorization')
+                with server._lock:
+                    server.requests_by_token[token] += 1
+                if token in server.unauthorized_tokens:
+                    return self._respond(401)
+
+                status = server._inject()
+                if status == 429:
+                    return self._respond(429, headers={'Retry-After': str(server.retry_after)})
+                if status is not None:
+                    return self._respond(status)
+
+                url = urlsplit(self.path)
+                jdata = server.route(method, url.path, parse_qs(url.query), body)
+                if jdata is None:
+                    return self._respond(404)
+                self._respond(200, jdata)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+        return Handler
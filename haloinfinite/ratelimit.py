@@ -0,0 +1,86 @@
+"""Host-wide token bucket rate limiting shared by every process calling the API."""
+
+
+import asyncio, os, struct, tempfile, time
+from collections import namedtuple
+
+from haloinfinite import util
+
+
+# requests per second refilled into the bucket and the max requests that can be sent in a burst
+Budget = namedtuple('Budget', ['rate', 'burst'])
+
+# bucket state on disk: tokens available and the wall clock time they were computed at
+_STATE = struct.Struct('<dd')
+
+
+class RateLimiter:
+    """Token buckets per endpoint family, stored in lock files so that all ApiService
+    instances and pool workers on the host draw from the same budget.
+
+    Buckets live under `directory` and are named by `scope` and family, so two limiters with
+    the same directory and scope share budgets even across unrelated processes. Use one scope
+    per account. Families without a budget are not limited.
+    """
+
+    DEFAULT_BUDGETS = {
+        'halostats': Budget(rate=10, burst=25),
+        'skill': Budget(rate=5, burst=10),
+        'discovery': Budget(rate=5, burst=10),
+        'profile': Budget(rate=2, burst=5)
+    }
+
+    def __init__(self, budgets:dict=None, directory:str=None, scope:str='default'):
+
+        self.budgets = dict(self.DEFAULT_BUDGETS if budgets is None else budgets)
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'haloinfinite-ratelimit')
+        self.scope = scope
+
+    def _bucket_path(self, family:str) -> str:
+
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f'{self.scope}-{family}.bucket')
+
+    def _take(self, family:str, tokens:float) -> float:
+        """Take tokens from the family's bucket if available.
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise seconds until enough tokens will be available.
+        """
+
+        budget = self.budgets.get(family)
+        if budget is None:
+            return 0
+
+        with util.locked_file(self._bucket_path(family)) as fd:
+            now = time.time()
+            data = os.read(fd, _STATE.size)
+            if len(data) == _STATE.size:
+                available, updated_at = _STATE.unpack(data)
+                available = min(budget.burst, available + max(0.0, now - updated_at) * budget.rate)
+            else:
+                # new bucket starts full
+                available = budget.burst
+
+            wait = 0
+            if available >= tokens:
+                available -= tokens
+            else:
+                wait = (tokens - available) / budget.rate
+
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, _STATE.pack(available, now))
+            return wait
+
+    def acquire(self, family:str, tokens:float=1) -> None:
+        """Block until the tokens can be taken from the family's bucket."""
+
+        while (wait := self._take(family, tokens)) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, family:str, tokens:float=1) -> None:
+
+        # taking tokens locks and reads the bucket file, keep that off the event loop
+        loop = asyncio.get_running_loop()
+        while (wait := await loop.run_in_executor(None, self._take, family, tokens)) > 0:
+            await asyncio.sleep(wait)
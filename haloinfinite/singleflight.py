@@ -0,0 +1,102 @@
+"""Coalescing of identical concurrent calls so only one of them does the work."""
+
+
+import asyncio, os, threading, zlib
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from haloinfinite import util
+
+
+class SingleFlight:
+    """Coalesces calls with the same key across threads. The first caller runs the function,
+    callers arriving while it runs wait and receive the same result (or exception)."""
+
+    def __init__(self):
+
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key:str, fn, *args, **kwargs):
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+
+        if not leader:
+            return call.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AsyncSingleFlight:
+    """SingleFlight for tasks on a single event loop."""
+
+    def __init__(self):
+
+        self._calls = {}
+
+    async def do(self, key:str, fn, *args, **kwargs):
+
+        call = self._calls.get(key)
+        if call is not None:
+            # shield so a cancelled follower doesn't cancel the leader's work
+            return await asyncio.shield(call)
+
+        call = self._calls[key] = asyncio.ensure_future(fn(*args, **kwargs))
+        try:
+            return await asyncio.shield(call)
+        finally:
+            if call.done():
+                del self._calls[key]
+            else:
+                call.add_done_callback(lambda _: self._calls.pop(key, None))
+
+
+class KeyLocks:
+    """Lock files that let processes on the host take turns on the same key, e.g. so one pool
+    worker fetches a response while the others wait and then read it from the response cache.
+
+    Keys are striped over a fixed number of lock files so the directory doesn't grow with
+    the number of keys seen, at the cost of rare waits between unrelated keys.
+    """
+
+    STRIPES = 4096
+
+    def __init__(self, directory:str):
+
+        self.directory = directory
+
+    @contextmanager
+    def hold(self, key:str):
+
+        os.makedirs(self.directory, exist_ok=True)
+        stripe = zlib.crc32(key.encode()) % self.STRIPES
+        with util.locked_file(os.path.join(self.directory, f'{stripe:04d}.lock')):
+            yield
+
+
+# one coalescer per process, shared by every ApiService in it
+_single_flights = {}
+_single_flights_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight:
+
+    pid = os.getpid()
+    with _single_flights_lock:
+        if pid not in _single_flights:
+            _single_flights[pid] = SingleFlight()
+        return _single_flights[pid]
@@ -0,0 +1,68 @@
+/*
+    Insert the maps, modes, playlists and seasons of new matches, and their versions.
+
+    Only runs for matches with a version missing from the dimension cache, see
+    Database.resolve_dimensions. Each insert skips existing rows with NOT EXISTS first, so
+    conflicts don't use up values of the (small) serial sequences, and ON CONFLICT covers rows
+    inserted by concurrent loaders since.
+*/
+
+CREATE TEMP TABLE tmp (
+    map_asset_id text,
+    map_version_id text,
+    map_level_id text,
+    game_variant_asset_id text,
+    game_variant_version_id text,
+    game_variant_category int,
+    playlist_asset_id text,
+    playlist_version_id text,
+    season_id text
+) ON COMMIT DROP;
+
+INSERT INTO tmp
+VALUES %s;
+
+INSERT INTO map (asset_id, level_id)
+SELECT DISTINCT map_asset_id, map_level_id
+FROM tmp s
+WHERE NOT EXISTS (SELECT 1 FROM map WHERE asset_id = s.map_asset_id)
+ON CONFLICT DO NOTHING;
+
+INSERT INTO map_version (map_id, version_id)
+SELECT DISTINCT m.id, s.map_version_id
+FROM tmp s
+JOIN map m ON m.asset_id = s.map_asset_id
+WHERE NOT EXISTS (SELECT 1 FROM map_version WHERE map_id = m.id AND version_id = s.map_version_id)
+ON CONFLICT (map_id, version_id) DO NOTHING;
+
+INSERT INTO mode (asset_id, category_id)
+SELECT DISTINCT game_variant_asset_id, game_variant_category
+FROM tmp s
+WHERE NOT EXISTS (SELECT 1 FROM mode WHERE asset_id = s.game_variant_asset_id)
+ON CONFLICT (asset_id) DO NOTHING;
+
+INSERT INTO mode_version (mode_id, version_id)
+SELECT DISTINCT m.id, s.game_variant_version_id
+FROM tmp s
+JOIN mode m ON m.asset_id = s.game_variant_asset_id
+WHERE NOT EXISTS (SELECT 1 FROM mode_version WHERE mode_id = m.id AND version_id = s.game_variant_version_id)
+ON CONFLICT (mode_id, version_id) DO NOTHING;
+
+INSERT INTO playlist (asset_id)
+SELECT DISTINCT playlist_asset_id
+FROM tmp s
+WHERE playlist_asset_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM playlist WHERE asset_id = s.playlist_asset_id)
+ON CONFLICT (asset_id) DO NOTHING;
+
+INSERT INTO playlist_version (playlist_id, version_id)
+SELECT DISTINCT p.id, s.playlist_version_id
+FROM tmp s
+JOIN playlist p ON p.asset_id = s.playlist_asset_id
+WHERE NOT EXISTS (SELECT 1 FROM playlist_version WHERE playlist_id = p.id AND version_id = s.playlist_version_id)
+ON CONFLICT (playlist_id, version_id) DO NOTHING;
+
+INSERT INTO season (name)
+SELECT DISTINCT season_id
+FROM tmp s
+WHERE season_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM season WHERE name = s.season_id)
+ON CONFLICT (name) DO NOTHING;
@@ -155,8 +155,8 @@ DROP TABLE IF EXISTS "public"."medal";
 CREATE TABLE "public"."medal" (
   "id" smallserial PRIMARY KEY,
   "api_id" int8 UNIQUE NOT NULL,
-  "name" text UNIQUE NOT NULL,
-  "description" text NOT NULL,
+  "name" text UNIQUE, -- null for medals first seen in match stats, until their metadata is loaded
+  "description" text,
   "medal_difficulty_id" int2 REFERENCES "medal_difficulty" ("id"),
   "medal_type_id" int2 REFERENCES "medal_type" ("id")
 );
@@ -194,8 +194,10 @@ DROP TABLE IF EXISTS "public"."player";
 CREATE TABLE "public"."player" (
   "id" serial PRIMARY KEY,
   "xuid" text NOT NULL UNIQUE, -- remove xuid() bracketing value for storage, the examples I've seen were 16 digits
-  "gamertag" text UNIQUE -- I believe max length is 12
+  "gamertag" text UNIQUE, -- I believe max length is 12
+  "in_queue" boolean NOT NULL DEFAULT false -- synced by the crawler, players only seen in loaded match stats aren't
 );
+CREATE INDEX ON "player" ("id") WHERE "in_queue";
 
 -- ----------------------------
 -- Table structure for team
@@ -240,7 +242,8 @@ INSERT INTO "outcome" ("id", "name")
 VALUES
   (1, 'tied'), -- this is a guess
   (2, 'won'),
-  (3, 'lost');
+  (3, 'lost'),
+  (4, 'left'); -- players who quit and bots removed before the end
   
 -- ----------------------------
 -- Table structure for season
@@ -285,6 +288,43 @@ CREATE TABLE "public"."job_player" (
   "player_id" int4 -- job can only have one player
 );
 
+-- ----------------------------
+-- Table structure for player_frontier
+-- ----------------------------
+DROP TABLE IF EXISTS "public"."player_frontier";
+CREATE TABLE "public"."player_frontier" (
+  "xuid" text PRIMARY KEY, -- discovered in a fetched match, unwrapped like player.xuid
+  "discovered_at" timestamptz(6) NOT NULL DEFAULT now(),
+  "promoted_at" timestamptz(6) -- when the player was added to the crawl queue
+);
+CREATE INDEX ON "player_frontier" ("discovered_at") WHERE "promoted_at" IS NULL;
+
+-- ----------------------------
+-- Table structure for player_sync
+-- ----------------------------
+DROP TABLE IF EXISTS "public"."player_sync";
+CREATE TABLE "public"."player_sync" (
+  "player_id" int4 PRIMARY KEY REFERENCES "player" ("id"),
+  "match_count" int4 NOT NULL, -- MatchesPlayedCount at the last probe
+  "probed_at" timestamptz(6) NOT NULL, -- last time the match count was checked
+  "synced_at" timestamptz(6), -- last time the count had changed and matches were retrieved
+  "sync_interval" real NOT NULL, -- seconds between probes, shrinks while the player is active and grows while idle
+  "next_probe_at" timestamptz(6) NOT NULL
+);
+CREATE INDEX ON "player_sync" ("next_probe_at");
+
+-- ----------------------------
+-- Table structure for work_lease
+-- ----------------------------
+DROP TABLE IF EXISTS "public"."work_lease";
+CREATE TABLE "public"."work_lease" (
+  "kind" text, -- 'player' for player syncs, 'match_details' for match stats
+  "item_id" int4, -- player.id or match.id
+  "leased_by" text NOT NULL, -- host:pid of the worker
+  "expires_at" timestamptz(6) NOT NULL, -- other workers may take the item after this, e.g. when the worker crashed
+  PRIMARY KEY ("kind", "item_id")
+);
+
 -- ----------------------------
 -- Table structure for match
 -- ----------------------------
@@ -301,7 +341,30 @@ CREATE TABLE "public"."match" (
   "started_at" timestamptz(3) NOT NULL,
   "completed_at" timestamptz(3) NOT NULL,
   "total_duration" int2 NOT NULL, -- seconds
-  "playable_duration" int2 NOT NULL -- seconds
+  "playable_duration" int2 NOT NULL, -- seconds
+  "details_loaded_at" timestamptz(6) -- when the match stats were loaded, null until then
+);
+CREATE INDEX ON "match" ("id") WHERE "details_loaded_at" IS NULL;
+
+-- ----------------------------
+-- Table structure for match_staging
+-- ----------------------------
+-- flattened matches, with their dimensions resolved to ids, are copied here and inserted into
+-- match by create_matches.sql in the same transaction, so the table only ever holds uncommitted
+-- rows and doesn't need to be crash safe
+DROP TABLE IF EXISTS "public"."match_staging";
+CREATE UNLOGGED TABLE "public"."match_staging" (
+  "guid" text,
+  "started_at" timestamptz(3),
+  "completed_at" timestamptz(3),
+  "duration" real,
+  "map_version_id" int2,
+  "mode_version_id" int2,
+  "playlist_version_id" int2,
+  "lifecycle_mode_id" int2,
+  "experience_id" int2,
+  "season_id" int2,
+  "playable_duration" real
 );
 
 -- ----------------------------
@@ -341,26 +404,28 @@ CREATE TABLE "public"."stats" (
   "grenade_kills" int2 NOT NULL,
   "headshot_kills" int2 NOT NULL,
   "power_weapon_kills" int2 NOT NULL,
-  "assassination_kills" int2 NOT NULL,
-  "vehicle_splatter_kills" int2 NOT NULL,
-  "repulsor_kills" int2 NOT NULL,
-  "fusion_coil_kills" int2 NOT NULL,
+  "assassination_kills" int2,
+  "vehicle_splatter_kills" int2,
+  "repulsor_kills" int2,
+  "fusion_coil_kills" int2, -- this and the 3 above aren't in the match stats response
   "emp_assists" int2 NOT NULL,
   "driver_assists" int2 NOT NULL,
   "callout_assists" int2 NOT NULL,
   "score_personal" int4 NOT NULL,
   "score_points" int2 NOT NULL,
   "mmr" real,
+  -- participation, null for team stats
   "participation_confirmed" bool,
-  "joined_in_progress" bool NOT NULL,
-  "joined_at" timestamptz(3) NOT NULL,
+  "joined_in_progress" bool,
+  "joined_at" timestamptz(3),
   "left_at" timestamptz(3),
-  "present_at_beginning" bool NOT NULL,
-  "present_at_completion" bool NOT NULL,
-  "kills_expected" real NOT NULL,
-  "kills_std_dev" real NOT NULL,
-  "deaths_expected" real NOT NULL,
-  "deaths_std_dev" real NOT NULL,
+  "present_at_beginning" bool,
+  "present_at_completion" bool,
+  -- from the skill endpoint, null until loaded
+  "kills_expected" real,
+  "kills_std_dev" real,
+  "deaths_expected" real,
+  "deaths_std_dev" real,
   "outcome_id" int2 NOT NULL REFERENCES "outcome" ("id"),
   "rank" int2 NOT NULL
 );
@@ -418,7 +483,7 @@ CREATE TABLE "public"."stats_medal" (
 -- ----------------------------
 DROP TABLE IF EXISTS "public"."stats_csr";
 CREATE TABLE "public"."stats_csr" (
-  "stats_id" int4 PRIMARY KEY REFERENCES "match_stats" ("id"),
+  "stats_id" int4 PRIMARY KEY REFERENCES "stats" ("id"),
   "pre_match" int2,
   "post_match" int2
 );
@@ -0,0 +1,285 @@
+"""Adaptive concurrency control for API requests, per authority (endpoint family)."""
+
+
+import asyncio, os, threading, time
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+# statuses that mean the service is overloaded and the request can be retried
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+def parse_retry_after(value:str) -> float:
+    """Parse a Retry-After header value, which is either delay seconds or an HTTP date.
+
+    Args:
+        value (str): The header value.
+
+    Returns:
+        float: Seconds to wait, or None if the value could not be parsed.
+    """
+
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class AuthorityStats:
+    """AIMD concurrency limit plus latency and error tracking for one authority, e.g. the halostats endpoint family.
+
+    The limit grows by roughly one slot per window of successful requests and is cut
+    multiplicatively on throttling, server errors, or latency well above the baseline.
+    """
+
+    ALPHA = 0.1 # smoothing for the latency/error moving averages
+    LATENCY_WINDOW = 200 # recent successful latencies kept for quantiles
+
+    def __init__(self, initial_limit:float, min_limit:float, max_limit:float, decrease_factor:float, latency_tolerance:float):
+
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+
+        self.in_flight = 0
+        self.latency = None # seconds, moving average
+        self.latencies = deque(maxlen=self.LATENCY_WINDOW)
+        self.baseline_latency = None # lowest moving average seen, decays upward slowly
+        self.error_rate = 0.0 # moving average of failed requests
+        self.blocked_until = 0.0 # monotonic time, set from Retry-After
+        self.last_decrease_at = 0.0
+
+    def has_capacity(self) -> bool:
+
+        return self.in_flight < int(self.limit) and time.monotonic() >= self.blocked_until
+
+    def wait_time(self) -> float:
+
+        return max(0.0, self.blocked_until - time.monotonic())
+
+    def latency_quantile(self, q:float) -> float:
+        """Get a quantile of the recent successful request latencies, None if there are none yet."""
+
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def record(self, latency:float, status:int, retry_after:float=None) -> None:
+        """Record the outcome of a request and adjust the limit.
+
+        Args:
+            latency (float): Request duration in seconds.
+            status (int): HTTP status code, None if the connection failed.
+            retry_after (float): Seconds the service asked us to wait, if any.
+        """
+
+        now = time.monotonic()
+        failed = status is None or status in RETRYABLE_STATUSES
+        self.error_rate += self.ALPHA * (float(failed) - self.error_rate)
+
+        if retry_after is not None:
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+
+        if failed:
+            self._decrease(now)
+            return
+
+        self.latencies.append(latency)
+        self.latency = latency if self.latency is None else self.latency + self.ALPHA * (latency - self.latency)
+        if self.baseline_latency is None or self.latency < self.baseline_latency:
+            self.baseline_latency = self.latency
+        else:
+            # let the baseline drift so a permanent shift in service latency isn't treated as congestion forever
+            self.baseline_latency *= 1.001
+
+        if self.latency > self.baseline_latency * self.latency_tolerance:
+            self._decrease(now)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _decrease(self, now:float) -> None:
+
+        # only back off once per round trip so a burst of failures from the same window doesn't collapse the limit
+        if now - self.last_decrease_at < (self.latency or 1.0):
+            return
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        self.last_decrease_at = now
+
+
+class ConcurrencyController:
+    """Gates concurrent requests per authority across the threads of a process."""
+
+    INITIAL_LIMIT = 8
+    MIN_LIMIT = 1
+    MAX_LIMIT = 128
+    DECREASE_FACTOR = 0.5
+    LATENCY_TOLERANCE = 2.0
+    HEDGE_QUANTILE = 0.95
+    HEDGE_MIN_SAMPLES = 20 # don't hedge until the latency distribution is known
+
+    def __init__(self):
+
+        self.authorities = {}
+        self._cond = threading.Condition()
+
+    def get_stats(self, authority:str) -> AuthorityStats:
+
+        stats = self.authorities.get(authority)
+        if stats is None:
+            stats = AuthorityStats(self.INITIAL_LIMIT, self.MIN_LIMIT, self.MAX_LIMIT, self.DECREASE_FACTOR, self.LATENCY_TOLERANCE)
+            self.authorities[authority] = stats
+        return stats
+
+    def hedge_delay(self, authority:str) -> float:
+        """Get how long to wait on a request before sending a duplicate, None if there isn't enough data yet."""
+
+        stats = self.get_stats(authority)
+        if len(stats.latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+        return stats.latency_quantile(self.HEDGE_QUANTILE)
+
+    def acquire(self, authority:str) -> None:
+
+        with self._cond:
+            stats = self.get_stats(authority)
+            while not stats.has_capacity():
+                # wake up on releases, or when a Retry-After block expires
+                self._cond.wait(stats.wait_time() or None)
+            stats.in_flight += 1
+
+    def try_acquire(self, authority:str) -> bool:
+        """Take a request slot only if one is free right away, e.g. for a hedged duplicate."""
+
+        with self._cond:
+            stats = self.get_stats(authority)
+            if not stats.has_capacity():
+                return False
+            stats.in_flight += 1
+            return True
+
+    def release_unused(self, authority:str) -> None:
+        """Give back a slot taken for a request that was never sent, without recording an outcome."""
+
+        with self._cond:
+            self.get_stats(authority).in_flight -= 1
+            self._cond.notify_all()
+
+    def release(self, authority:str, latency:float, status:int, retry_after:float=None) -> None:
+
+        with self._cond:
+            stats = self.get_stats(authority)
+            stats.in_flight -= 1
+            stats.record(latency, status, retry_after)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, authority:str):
+        """Hold a request slot for the authority. Set `status` and `retry_after` on the yielded
+        object before leaving the block, a block that raises is recorded as a failed connection."""
+
+        self.acquire(authority)
+        outcome = _Outcome()
+        started_at = time.monotonic()
+        try:
+            yield outcome
+        finally:
+            self.release(authority, time.monotonic() - started_at, outcome.status, outcome.retry_after)
+
+
+class AsyncConcurrencyController(ConcurrencyController):
+    """ConcurrencyController for tasks on a single event loop."""
+
+    def __init__(self):
+
+        super().__init__()
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, authority:str) -> None:
+
+        async with self._cond:
+            stats = self.get_stats(authority)
+            while not stats.has_capacity():
+                try:
+                    await asyncio.wait_for(self._cond.wait(), stats.wait_time() or None)
+                except asyncio.TimeoutError:
+                    pass
+            stats.in_flight += 1
+
+    def try_acquire(self, authority:str) -> bool:
+
+        # tasks on one loop can't interleave between the check and the increment
+        stats = self.get_stats(authority)
+        if not stats.has_capacity():
+            return False
+        stats.in_flight += 1
+        return True
+
+    async def release(self, authority:str, latency:float, status:int, retry_after:float=None) -> None:
+
+        async with self._cond:
+            stats = self.get_stats(authority)
+            stats.in_flight -= 1
+            stats.record(latency, status, retry_after)
+            self._cond.notify_all()
+
+    async def release_unused(self, authority:str) -> None:
+
+        async with self._cond:
+            self.get_stats(authority).in_flight -= 1
+            self._cond.notify_all()
+
+    async def abandon(self, authority:str, latency:float) -> None:
+        """Release a slot whose request was cancelled before it finished, e.g. the losing side of a hedge.
+        Its running time is kept as a latency sample, a lower bound, so cancelling the slow tail doesn't hide it
+        from the hedge delay, but it doesn't count towards the limit or the error rate."""
+
+        async with self._cond:
+            stats = self.get_stats(authority)
+            stats.in_flight -= 1
+            stats.latencies.append(latency)
+            self._cond.notify_all()
+
+    @asynccontextmanager
+    async def slot(self, authority:str):
+
+        await self.acquire(authority)
+        outcome = _Outcome()
+        started_at = time.monotonic()
+        try:
+            yield outcome
+        finally:
+            await self.release(authority, time.monotonic() - started_at, outcome.status, outcome.retry_after)
+
+
+class _Outcome:
+
+    def __init__(self):
+
+        self.status = None
+        self.retry_after = None
+
+
+# one controller per process so every ApiService in the process shares what it learns about each authority
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_controller() -> ConcurrencyController:
+
+    pid = os.getpid()
+    with _controllers_lock:
+        if pid not in _controllers:
+            _controllers[pid] = ConcurrencyController()
+        return _controllers[pid]
@@ -0,0 +1,207 @@
+"""Record and replay of the HTTP traffic sent by ApiService.
+
+Attach a RecordingTransport to an ApiService (or AsyncApiService) to capture every exchange
+into a TrafficArchive, then attach a ReplayTransport reading the same archive to run jobs
+offline against the captured traffic, e.g. to profile MatchJob without touching the service.
+"""
+
+
+import asyncio, hashlib, json, os, sqlite3, threading, time, zlib
+from contextlib import asynccontextmanager
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+def _prepare_url(method:str, url:str, params=None) -> str:
+    """Get the url with its encoded query string. Accepts params as a dict or a list of pairs."""
+
+    return requests.Request(method, url, params=params).prepare().url
+
+
+def make_key(method:str, url:str, params=None, js:dict=None) -> str:
+
+    raw = json.dumps([method.upper(), _prepare_url(method, url, params), js], sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class TrafficArchive:
+    """SQLite file of request/response exchanges, indexed by request key, with compressed bodies.
+    Safe to write from several pool processes at once."""
+
+    COMPRESSION_LEVEL = 6
+
+    def __init__(self, path:str):
+
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS exchange (
+                    id integer PRIMARY KEY,
+                    key text NOT NULL,
+                    method text NOT NULL,
+                    url text NOT NULL, -- includes the query string
+                    request_json text,
+                    status int NOT NULL,
+                    headers text NOT NULL,
+                    body blob NOT NULL, -- zlib compressed
+                    started_at real NOT NULL, -- epoch seconds
+                    elapsed real NOT NULL -- seconds
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS exchange_key ON exchange (key, id)')
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def add(self, method:str, url:str, params, js:dict, status:int, headers:dict, body:bytes, started_at:float, elapsed:float) -> None:
+
+        row = (
+            make_key(method, url, params, js),
+            method.upper(),
+            _prepare_url(method, url, params),
+            None if js is None else json.dumps(js),
+            status,
+            json.dumps(dict(headers)),
+            zlib.compress(body, self.COMPRESSION_LEVEL),
+            started_at,
+            elapsed
+        )
+        with self._lock:
+            self._connect().execute('''
+                INSERT INTO exchange (key, method, url, request_json, status, headers, body, started_at, elapsed)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', row)
+
+    def find(self, key:str) -> list[tuple]:
+        """Get the (status, headers, body, elapsed) of each exchange recorded for the key, in recorded order."""
+
+        with self._lock:
+            rows = self._connect().execute('''
+                SELECT status, headers, body, elapsed
+                FROM exchange
+                WHERE key = ?
+                ORDER BY id
+            ''', (key,)).fetchall()
+        return [(status, json.loads(headers), zlib.decompress(body), elapsed) for status, headers, body, elapsed in rows]
+
+
+class RecordingTransport:
+    """Sends requests through the service's sessions and records each exchange."""
+
+    def __init__(self, archive_path:str):
+
+        self.archive = TrafficArchive(archive_path)
+
+    def send(self, session:requests.Session, method:str, url:str, params=None, json:dict=None, **kwargs) -> requests.Response:
+
+        started_at = time.time()
+        resp = session.request(method, url, params=params, json=json, **kwargs)
+        self.archive.add(method, url, params, json, resp.status_code, resp.headers, resp.content, started_at, time.time() - started_at)
+        return resp
+
+    @asynccontextmanager
+    async def send_async(self, session, method:str, url:str, params=None, json:dict=None, **kwargs):
+
+        started_at = time.time()
+        async with session.request(method, url, params=params, json=json, **kwargs) as resp:
+            # aiohttp keeps the body after the first read, so the caller can still read it
+            body = await resp.read()
+            self.archive.add(method, url, params, json, resp.status, resp.headers, body, started_at, time.time() - started_at)
+            yield resp
+
+
+class ReplayedResponse:
+    """Recorded response, usable where ApiService expects a requests.Response or an aiohttp response."""
+
+    def __init__(self, url:str, status:int, headers:dict, body:bytes):
+
+        self.url = url
+        self.status = self.status_code = status
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = body
+
+    def raise_for_status(self) -> None:
+
+        if self.status >= 400:
+            raise requests.HTTPError(f'{self.status} Error (replayed) for url: {self.url}', response=self)
+
+    async def read(self) -> bytes:
+
+        return self.content
+
+
+class ReplayTransport:
+    """Answers requests from a TrafficArchive without touching the network.
+
+    Requests recorded more than once are answered with each recording in turn, wrapping
+    around when they run out. With `original_timing`, each response is delayed by the
+    time it originally took, otherwise the archive is replayed as fast as possible.
+    """
+
+    def __init__(self, archive_path:str, original_timing:bool=False):
+
+        self.archive = TrafficArchive(archive_path)
+        self.original_timing = original_timing
+        self._cursors = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _next(self, method:str, url:str, params, js:dict) -> tuple:
+
+        key = make_key(method, url, params, js)
+        recordings = self.archive.find(key)
+        if not recordings:
+            raise LookupError(f'No recorded response for {method} {_prepare_url(method, url, params)}')
+
+        with self._lock:
+            i = self._cursors.get(key, 0)
+            self._cursors[key] = i + 1
+        status, headers, body, elapsed = recordings[i % len(recordings)]
+        return ReplayedResponse(url, status, headers, body), elapsed
+
+    def send(self, session, method:str, url:str, params=None, json:dict=None, **kwargs) -> ReplayedResponse:
+
+        resp, elapsed = self._next(method, url, params, json)
+        if self.original_timing:
+            time.sleep(elapsed)
+        return resp
+
+    @asynccontextmanager
+    async def send_async(self, session, method:str, url:str, params=None, json:dict=None, **kwargs):
+
+        resp, elapsed = self._next(method, url, params, json)
+        if self.original_timing:
+            await asyncio.sleep(elapsed)
+        yield resp
@@ -1,11 +1,19 @@
 
 import os
 import pkgutil
+import socket
+from contextlib import contextmanager
 from typing import Generator
 import yaml, re
 from yaml.loader import SafeLoader
 import datetime as dt
 
+try:
+    import fcntl
+except ImportError: # windows
+    fcntl = None
+    import msvcrt
+
 
 def get_package_data(rel_file_path:str):
 
@@ -25,6 +33,27 @@ def batch(iterable, n:int=1) -> Generator:
         yield iterable[i:min(i + n, l)]
 
 
+@contextmanager
+def locked_file(path:str):
+    """Open a file, creating it if needed, and hold an exclusive lock on it for the duration of the context.
+    The lock is shared by every process on the host, including threads of the same process.
+
+    Yields:
+        int: The file descriptor.
+    """
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+        yield fd
+    finally:
+        # closing the descriptor releases the lock
+        os.close(fd)
+
+
 def find(lst, key, value):
 
     for i, dic in enumerate(lst):
@@ -96,4 +125,10 @@ def parse_iso_duration(duration:str) -> float:
 def get_available_cpu_count():
 
     # TODO return available, not physical
-    return os.cpu_count()
\ No newline at end of file
+    return os.cpu_count()
+
+
+def worker_id() -> str:
+    """Identify this process among the workers of every host sharing the database, e.g. for leases."""
+
+    return f'{socket.gethostname()}:{os.getpid()}'
@@ -0,0 +1,17 @@
+from haloinfinite import auth, api, db, job, ratelimit
+
+
+if __name__ == '__main__':
+
+    auth_mgr = auth.AuthManager()
+
+    hapi = api.ApiService(auth_mgr, rate_limiter=ratelimit.RateLimiter())
+    hapi.verify_or_refresh_tokens()
+
+    pgdb = db.Database(db.TEST_DB)
+
+    # loads every match without stats, run it on several hosts to share the backlog
+    mdj = job.MatchDetailsJob(hapi, pgdb)
+
+    with auth.TokenRefresher(auth_mgr):
+        mdj.run_async()
@@ -1,5 +1,5 @@
 import json
-from haloinfinite import auth, api, db, job
+from haloinfinite import auth, api, db, job, ratelimit
 
 
 if __name__ == '__main__':
@@ -7,7 +7,7 @@ if __name__ == '__main__':
     auth_mgr = auth.AuthManager()
     # auth_mgr.generate_new_spartan_token()
 
-    hapi = api.ApiService(auth_mgr)
+    hapi = api.ApiService(auth_mgr, rate_limiter=ratelimit.RateLimiter())
     hapi.verify_or_refresh_tokens()
 
     pgdb = db.Database(db.TEST_DB)
@@ -15,4 +15,5 @@ if __name__ == '__main__':
 
     mdj = job.MetadataJob(hapi, pgdb)
 
-    mdj.run()
+    with auth.TokenRefresher(auth_mgr):
+        mdj.run()
@@ -1,4 +1,4 @@
-from haloinfinite import auth, api, db, job
+from haloinfinite import auth, api, db, job, ratelimit
 
 
 if __name__ == '__main__':
@@ -6,7 +6,7 @@ if __name__ == '__main__':
     auth_mgr = auth.AuthManager()
     # auth_mgr.generate_new_spartan_token()
 
-    hapi = api.ApiService(auth_mgr)
+    hapi = api.ApiService(auth_mgr, rate_limiter=ratelimit.RateLimiter())
     hapi.verify_or_refresh_tokens()
 
     pgdb = db.Database(db.TEST_DB)
@@ -16,4 +16,6 @@ if __name__ == '__main__':
 
     mj = job.MatchJob(pid, hapi, pgdb)
 
-    mj.run()
\ No newline at end of file
+    # renew the spartan token in the background so long backfills don't outlive it
+    with auth.TokenRefresher(auth_mgr):
+        mj.run()
\ No newline at end of file
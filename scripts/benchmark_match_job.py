@@ -0,0 +1,52 @@
+"""Measure MatchJob throughput against the local mock API server.
+
+Runs against the test database, which is re-initialized.
+
+    python scripts/benchmark_match_job.py --matches 5000 --latency 0.1 --throttle-rate 0.02 --mode async
+"""
+
+
+import argparse
+
+from haloinfinite import api, db, identity, job, mockserver
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--matches', type=int, default=2000, help='length of the synthesized match history')
+    parser.add_argument('--latency', type=float, default=0.05, help='median response latency in seconds')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='log-normal shape, higher values give a longer tail')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests answered with 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After seconds sent with 429s')
+    parser.add_argument('--mode', choices=['sync', 'async'], default='sync')
+    parser.add_argument('--in-flight', type=int, default=64, help='max page requests in flight for the async mode')
+    parser.add_argument('--write-batch-size', type=int, default=job.MatchJob.WRITE_BATCH_SIZE, help='matches merged into one database write')
+    parser.add_argument('--identities', type=int, default=1, help='fake accounts to spread requests across')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    server = mockserver.MockHaloServer(history_length=args.matches, latency_median=args.latency, latency_sigma=args.latency_sigma,
+        throttle_rate=args.throttle_rate, error_rate=args.error_rate, retry_after=args.retry_after, seed=args.seed)
+
+    with server:
+        if args.identities > 1:
+            auth_mgrs = [mockserver.MockAuthManager(f'mock{i}') for i in range(args.identities)]
+            pool = identity.IdentityPool.from_auth_managers(auth_mgrs, budgets={})
+            hapi = api.ApiService(None, base_urls=server.base_urls, identities=pool)
+        else:
+            hapi = api.ApiService(mockserver.MockAuthManager(), base_urls=server.base_urls)
+
+        pgdb = db.Database(db.TEST_DB)
+        pgdb.init()
+        pid = pgdb.create_player('xuid(2535445291321133)')
+
+        mj = job.MatchJob(pid, hapi, pgdb, write_batch_size=args.write_batch_size)
+        if args.mode == 'async':
+            mj.run_async(args.in_flight)
+        else:
+            mj.run()
+
+    print('Mock server responses by status:', dict(server.statuses))
+    print('Mock server requests by token:', dict(server.requests_by_token))
@@ -0,0 +1,115 @@
+import json, os, re, unittest
+from contextlib import contextmanager
+from io import StringIO
+from unittest import mock
+
+from haloinfinite import db, flatten as flat, util
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+BOT_MATCH_FILE = '6ff6af98-5696-413a-a315-afc74e36fdbe.json'
+
+
+def load_fixture(file_name:str) -> dict:
+
+    with open(os.path.join(DATA_DIR, file_name)) as f:
+        return json.load(f)
+
+
+def seeded_outcome_ids() -> set:
+
+    init_sql = util.get_package_data('sql/init.sql').decode()
+    values = re.search(r'INSERT INTO "outcome" \("id", "name"\)\s*VALUES(.*?);', init_sql, re.S).group(1)
+    return {int(i) for i in re.findall(r'\((\d+),', values)}
+
+
+class FakeCursor:
+    """Answers the queries of Database.create_match_details and keeps the rows it copies, per table."""
+
+    def __init__(self, match_ids:dict):
+
+        self.match_ids = match_ids
+        self.copied = {}
+        self._rows = []
+
+    def execute(self, sql:str, args:tuple=None):
+
+        if 'FOR UPDATE' in sql:
+            self._rows = [(guid, self.match_ids[guid]) for guid in args[0] if guid in self.match_ids]
+        elif 'nextval' in sql:
+            self._rows = [(i,) for i in range(1, args[1] + 1)]
+        elif sql.startswith('SELECT'):
+            # ids of the keys of _get_or_create_ids
+            self._rows = [(k, i) for i, k in enumerate(args[0], 1)]
+        else:
+            self._rows = []
+
+    def fetchall(self) -> list:
+
+        return self._rows
+
+    def copy_expert(self, sql:str, buf:StringIO):
+
+        table, columns = re.match(r'COPY (\w+) \((.*?)\) FROM STDIN', sql).groups()
+        rows = [dict(zip(columns.split(', '), line.split('\t'))) for line in buf.read().splitlines()]
+        self.copied.setdefault(table, []).extend(rows)
+
+
+class FakeConnection:
+
+    def __init__(self, cur:FakeCursor):
+
+        self.cur = cur
+        self.committed = False
+
+    def cursor(self):
+
+        return self.cur
+
+    def commit(self):
+
+        self.committed = True
+
+
+class TestMatchDetails(unittest.TestCase):
+
+    def setUp(self):
+
+        self.jdata = load_fixture(BOT_MATCH_FILE)
+        self.details = flat.flatten_match_details(self.jdata)
+
+    def test_flatten_bots(self):
+
+        self.assertEqual(len(self.details['bots']), 2)
+        self.assertEqual({b['id'] for b in self.details['bots']}, {'56.0', '40.0'})
+        self.assertTrue(all(not p['id'].startswith('xuid(') for p in self.details['players']))
+
+    def test_outcomes_are_seeded(self):
+
+        outcomes = {o['stats']['outcome_id'] for kind in ('teams', 'players', 'bots') for o in self.details[kind]}
+        self.assertIn(4, outcomes)
+        self.assertLessEqual(outcomes, seeded_outcome_ids())
+
+    def test_load(self):
+
+        cur = FakeCursor({self.details['guid']: 1})
+        conn = FakeConnection(cur)
+
+        @contextmanager
+        def connect(join=True):
+            yield conn
+
+        pgdb = db.Database.__new__(db.Database)
+        with mock.patch.object(pgdb, 'connect', connect), mock.patch.object(db, 'execute_values'):
+            loaded = pgdb.create_match_details([self.details])
+
+        self.assertEqual(loaded, 1)
+        self.assertTrue(conn.committed)
+        owners = len(self.details['teams']) + len(self.details['players']) + len(self.details['bots'])
+        self.assertEqual(len(cur.copied['stats']), owners)
+        self.assertEqual(len(cur.copied['match_bot']), 2)
+        # stats.outcome_id references the outcome table
+        self.assertLessEqual({int(s['outcome_id']) for s in cur.copied['stats']}, seeded_outcome_ids())
+
+
+if __name__ == '__main__':
+    unittest.main()